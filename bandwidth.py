@@ -0,0 +1,45 @@
+from threading import Lock
+from time import monotonic, sleep
+
+
+TRAFFIC = ["view", "prefetch", "save"]  # view - the image the user waits for, prefetch - the queue, save - downloads
+
+
+class TokenBucket:  # Up to one second of the rate may be spent at once
+    def __init__(self, rate=0):
+        self.lock = Lock()
+        self.rate = rate  # bytes/s, 0 for unlimited
+        self.tokens = rate
+        self.last = monotonic()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.tokens = min(self.tokens, rate)
+
+    def consume(self, amount, stopped=lambda: False):  # Blocks until the amount may be spent or stopped
+        while not stopped():
+            with self.lock:
+                if self.rate <= 0:
+                    return
+                now = monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                needed = min(amount, self.rate)  # Chunks larger than the burst run into debt instead
+                if self.tokens >= needed:
+                    self.tokens -= amount
+                    return
+                wait = (needed - self.tokens) / self.rate
+            sleep(min(wait, 0.1))  # Wake up now and then to notice a stop or a new rate
+
+
+_buckets = {traffic: TokenBucket() for traffic in TRAFFIC}
+
+
+def set_bandwidth(configs):  # Rates in KB/s from the settings, applied to the downloads already running too
+    for traffic in TRAFFIC:
+        _buckets[traffic].set_rate(configs["bandwidth_" + traffic] * 1024)
+
+
+def throttle(traffic, amount, stopped=lambda: False):
+    _buckets[traffic].consume(amount, stopped)
@@ -1,6 +1,6 @@
 from json import load as j_load, dump as j_dump, JSONDecodeError
 from os.path import exists, join as p_join
-from os import remove
+from os import remove, makedirs, listdir, replace
 from sys import exit
 
 from PyQt6.QtWidgets import QMessageBox
@@ -10,11 +10,53 @@ class DecodeError(Exception):
     ...
 
 
-def load_config(path, mainwindow):
-    if exists(p_join(path, 'settings.json')):
+def default_configs(path):
+    return {
+        "cache_num": 5,
+        "keep_num": 5,
+        "view_quality": "small",
+        "save_quality": "original",
+        "save_dir": p_join(path, "out"),
+        "tag": [],
+        "authors": [],
+        "r18": 0,
+        "ex_ai": 0,
+        "suppress_warnings": 0,
+        "excluded_tags": [],
+        "excluded_authors": [],
+        "persist_queue": 2,
+        "shutdown_timeout": 3,
+        "process_pool": 0,
+        "save_format": "",
+        "save_image_quality": 90,
+        "save_max_size": 0,
+        "save_sidecar": 0,
+        "bandwidth_view": 0,
+        "bandwidth_prefetch": 0,
+        "bandwidth_save": 0,
+        "slideshow_interval": 10
+    }
+
+
+def settings_file(profile=None):  # Every profile keeps its own settings and queue
+    return f"settings-{profile}.json" if profile else "settings.json"
+
+
+def cache_dir(path, profile=None):
+    return p_join(path, f"cache-{profile}" if profile else "cache")
+
+
+def valid_profile(profile):
+    return bool(profile) and len(profile) <= 32 and all(x.isalnum() or x in "-_" for x in profile)
+
+
+def load_config(path, mainwindow, profile=None):
+    if exists(p_join(path, settings_file(profile))):
         try:
-            with open(p_join(path, "settings.json"), 'r') as f:
+            with open(p_join(path, settings_file(profile)), 'r', encoding='utf-8') as f:
                 j = j_load(f)
+            for k, v in default_configs(path).items():  # Fill in the keys added by newer versions
+                j.setdefault(k, v)
             if verify_settings(j):
                 return j
             raise DecodeError
@@ -24,33 +66,25 @@ def load_config(path, mainwindow):
             if r == QMessageBox.StandardButton.No:
                 exit(-1)
             else:
-                remove(p_join(path, 'settings.json'))
-                return load_config(path, mainwindow)
+                remove(p_join(path, settings_file(profile)))
+                return load_config(path, mainwindow, profile)
     else:
-        configs = {
-            "cache_num": 5,
-            "keep_num": 5,
-            "view_quality": "small",
-            "save_quality": "original",
-            "save_dir": p_join(path, "out"),
-            "tag": [],
-            "authors": [],
-            "r18": 0,
-            "ex_ai": 0,
-            "suppress_warnings": 0
-        }
-        with open(p_join(path, "settings.json"), 'w') as f:
+        configs = default_configs(path)
+        with open(p_join(path, settings_file(profile)), 'w', encoding='utf-8') as f:
             j_dump(configs, f, indent=4)
         return configs
 
 
 def verify_settings(c):
     if all([x in c.keys() for x in ["cache_num", "keep_num", "view_quality", "save_quality", "save_dir", "tag",
-                                    "r18", "ex_ai", "suppress_warnings", "authors"]]):
+                                    "r18", "ex_ai", "suppress_warnings", "authors", "excluded_tags",
+                                    "excluded_authors", "persist_queue", "shutdown_timeout", "process_pool",
+                                    "save_format", "save_image_quality", "save_max_size", "save_sidecar",
+                                    "bandwidth_view", "bandwidth_prefetch", "bandwidth_save", "slideshow_interval"]]):
         status = True
         if c["cache_num"] not in range(20):
             status = False
-        if c["keep_num"] not in range(20):
+        if c["keep_num"] not in range(501):  # History is kept encoded, so far more entries fit
             status = False
         if c["view_quality"] not in ["thumb", "mini", "small", "regular", "original"]:
             status = False
@@ -62,17 +96,84 @@ def verify_settings(c):
             status = False
         if c["suppress_warnings"] not in [0, 1]:
             status = False
+        if c["persist_queue"] not in [0, 1, 2]:
+            status = False
+        if c["shutdown_timeout"] not in range(1, 61):
+            status = False
+        if c["process_pool"] not in [0, 1]:
+            status = False
+        if c["save_format"] not in ["", "jpg", "png", "webp"]:
+            status = False
+        if c["save_image_quality"] not in range(1, 101):
+            status = False
+        if c["save_max_size"] not in range(0, 100001):
+            status = False
+        if c["save_sidecar"] not in [0, 1]:
+            status = False
+        for k in ["bandwidth_view", "bandwidth_prefetch", "bandwidth_save"]:  # KB/s, 0 for unlimited
+            if c[k] not in range(0, 1000001):
+                status = False
+        if c["slideshow_interval"] not in range(1, 3601):
+            status = False
         if not exists(c["save_dir"]):
             status = False
         if type(c["authors"]) is not list or type(c["tag"]) is not list:
             status = False
-        if status:
-            if len(c["authors"]) > 20:
-                status = False
+        if type(c["excluded_tags"]) is not list or type(c["excluded_authors"]) is not list:
+            status = False
         return status
     return False
 
 
-def save_settings(path, c):
-    with open(p_join(path, "settings.json"), 'w') as f:
-        j_dump(c, f, indent=4, ensure_ascii=False)
+def dump_atomic(file, obj, **kwargs):  # Write a temporary file then swap it in, never leaving a truncated file
+    with open(file + ".tmp", 'w', encoding='utf-8') as f:  # Titles and tags are written as they are
+        j_dump(obj, f, **kwargs)
+    replace(file + ".tmp", file)
+
+
+def save_settings(path, c, profile=None):
+    dump_atomic(p_join(path, settings_file(profile)), c, indent=4, ensure_ascii=False)
+
+
+QUEUE_KEYS = ["view_quality", "tag", "authors", "r18", "ex_ai", "excluded_tags", "excluded_authors"]
+
+
+# persist_queue: 0 - off, 1 - metadata only, 2 - with prefetched images
+def save_queue(path, c, image_data, images, profile=None):
+    cache = cache_dir(path, profile)
+    makedirs(cache, exist_ok=True)
+    for name in listdir(cache):
+        remove(p_join(cache, name))
+    if not c["persist_queue"]:
+        return
+    prefetched = []
+    not_persisted = []
+    for _, data, raw in images:
+        if c["persist_queue"] == 2 and raw:
+            name = f'{data["pid"]}_{data["p"]}.{data["ext"]}'
+            with open(p_join(cache, name), 'wb') as f:
+                f.write(raw)
+            prefetched.append({"data": data, "file": name})
+        else:
+            not_persisted.append(data)
+    image_data = not_persisted + image_data
+    dump_atomic(p_join(cache, "queue.json"),
+                {"configs": {k: c[k] for k in QUEUE_KEYS}, "image_data": image_data, "images": prefetched},
+                ensure_ascii=False)
+
+
+def load_queue(path, c, profile=None):
+    cache = cache_dir(path, profile)
+    try:
+        with open(p_join(cache, "queue.json"), 'r', encoding='utf-8') as f:
+            j = j_load(f)
+        remove(p_join(cache, "queue.json"))  # Restore only once
+        if j["configs"] != {k: c[k] for k in QUEUE_KEYS}:  # Queued for different settings
+            return [], []
+        images = []
+        for item in j["images"]:
+            with open(p_join(cache, item["file"]), 'rb') as f:
+                images.append((item["data"], f.read()))
+        return j["image_data"], images
+    except (OSError, JSONDecodeError, UnicodeDecodeError, KeyError, TypeError):
+        return [], []
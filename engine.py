@@ -0,0 +1,209 @@
+from PyQt6.QtCore import QObject, QThreadPool
+from collections import OrderedDict
+
+from bandwidth import TRAFFIC, set_bandwidth
+from gallery import SaveIndex
+from imaging import set_process_pool
+from network import MAX_CONNECTIONS
+from search import TagIndex
+from threads import DownloaderWorker, TagIndexWorker
+
+
+CACHE_BYTES = 256 * 1024 * 1024  # Encoded images kept for the other windows
+JUMP_PRIORITY = 3  # Priorities in the shared thread pools
+VIEW_PRIORITY = 2
+THUMBNAIL_PRIORITY = 1
+SAVE_PRIORITY = 0
+QUALITIES = ["original", "regular", "small", "thumb", "mini"]  # Largest first
+TYPICAL_SIZES = {"original": 3000000, "regular": 600000, "small": 150000, "thumb": 40000, "mini": 10000}  # Bytes
+TYPICAL_RATE = 500000  # Bytes/s, until a download has been measured
+
+
+class Subscription:
+    def __init__(self, window, uid, data):
+        self.window = window
+        self.uid = uid
+        self.data = data
+
+
+class Task:
+    def __init__(self, worker):
+        self.worker = worker
+        self.subscriptions = []
+
+
+class ThroughputEstimator:  # Moving averages of the download rate and of the file size of each quality
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.rate = None
+        self.latency = 0.0  # Seconds before the first byte, taken from the smallest files
+        self.sizes = {}
+
+    def average(self, old, new):
+        return new if old is None else old + self.alpha * (new - old)
+
+    def record(self, quality, size, elapsed):
+        self.sizes[quality] = self.average(self.sizes.get(quality), size)
+        if size < 100000:  # Small files are dominated by the round-trip
+            self.latency = self.average(self.latency, elapsed)
+        else:
+            self.rate = self.average(self.rate, size / max(elapsed - self.latency, 0.001))
+
+    def estimate(self, quality):  # Seconds for one image of the quality
+        size = self.sizes.get(quality, TYPICAL_SIZES[quality])
+        return self.latency + size / (self.rate or TYPICAL_RATE)
+
+
+class DownloadEngine(QObject):  # Process-wide owner of the thread pools, the image cache and the running downloads
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        super().__init__()
+        self.thread_pool = QThreadPool()
+        self.thread_pool.setMaxThreadCount(MAX_CONNECTIONS)  # Downloads, thumbnails and decoding ahead
+        self.background_pool = QThreadPool()  # Fetching URLs, saving and the work on the save directory
+        self.windows = []
+        self.tasks = {}  # (source, type) -> Task, one download however many windows want it
+        self.workers = {}  # worker uuid -> (source, type)
+        self.cache = OrderedDict()  # source -> encoded bytes, LRU
+        self.cache_bytes = 0
+        self.estimator = ThroughputEstimator()
+        self.save_index = None
+        self.tag_index = None
+        self.index_worker = None
+
+    def register(self, window, path):
+        if self.save_index is None:  # Shared, every window would otherwise overwrite the others' index file
+            self.save_index = SaveIndex(path)
+            self.save_index.load()
+            self.tag_index = TagIndex(path)  # Searchable from the moment it is read, filled as images are fetched
+            worker = TagIndexWorker(path)
+            worker.signals.finish_index.connect(self.tag_index.merge)
+            self.index_worker = worker  # Stopped when the last window closes
+            self.background_pool.start(worker, THUMBNAIL_PRIORITY)
+        self.windows.append(window)
+        window.term_signal.connect(lambda type_: self.terminate(window, type_))
+        self.apply_settings()
+
+    def unregister(self, window):  # Returns the number of windows left
+        if window in self.windows:
+            self.windows.remove(window)
+            if self.windows:
+                self.apply_settings()
+        if not self.windows and self.index_worker is not None:
+            self.index_worker.signals.terminate.emit("all")
+        return len(self.windows)
+
+    def apply_settings(self):  # Process-wide settings, combined over the profiles of the open windows
+        # The strictest bandwidth limit any window sets, and the process pool if any window wants it
+        rates = {}
+        for traffic in TRAFFIC:
+            limits = [x.configs["bandwidth_" + traffic] for x in self.windows if x.configs["bandwidth_" + traffic]]
+            rates["bandwidth_" + traffic] = min(limits, default=0)
+        set_bandwidth(rates)
+        set_process_pool(any(x.configs["process_pool"] for x in self.windows))
+
+    def download(self, window, data, uid, configs, type_="fetch", size=None, priority=VIEW_PRIORITY, traffic=None):
+        source = DownloaderWorker.source(data, configs, type_)
+        key = (source, type_)
+        window.update_progress(uid, 0)
+        if key in self.tasks:  # Already being downloaded for some window
+            self.tasks[key].subscriptions.append(Subscription(window, uid, data))
+            return
+        raw = self.cache_get(source) if type_ != "download" else None
+        worker = DownloaderWorker(data, uid, configs, type_, size, raw, traffic)
+        task = Task(worker)
+        task.subscriptions.append(Subscription(window, uid, data))
+        self.tasks[key] = task
+        self.workers[worker.uuid] = key
+        worker.signals.progress.connect(self.task_progress)
+        worker.signals.preview.connect(self.task_preview)
+        worker.signals.error.connect(self.task_error)
+        worker.signals.finish_download.connect(self.task_finished)
+        worker.signals.stop.connect(self.task_stopped)
+        self.thread_pool.start(worker, priority)
+
+    def pop_task(self, worker_uid):
+        key = self.workers.pop(worker_uid, None)
+        return self.tasks.pop(key, None)
+
+    def task_progress(self, worker_uid, progress):
+        key = self.workers.get(worker_uid)
+        if key in self.tasks:
+            for subscription in self.tasks[key].subscriptions:
+                subscription.window.update_progress(subscription.uid, progress)
+
+    def task_preview(self, worker_uid, image):
+        key = self.workers.get(worker_uid)
+        if key in self.tasks:
+            for subscription in self.tasks[key].subscriptions:
+                subscription.window.show_preview(subscription.uid, subscription.data, image)
+
+    def task_error(self, error, worker_uid):
+        task = self.pop_task(worker_uid)
+        if task is not None:
+            for subscription in task.subscriptions:
+                subscription.window.deal_errors(error, subscription.uid)
+
+    def task_stopped(self, worker_uid):
+        task = self.pop_task(worker_uid)
+        if task is not None:
+            for subscription in task.subscriptions:
+                subscription.window.cleanup_progress(subscription.uid)
+
+    def task_finished(self, pixmap, worker_uid, data, raw):
+        task = self.pop_task(worker_uid)
+        if task is None:
+            return
+        if task.worker.elapsed is not None and raw:
+            quality = task.worker.configs["save_quality" if task.worker.type == "download" else "view_quality"]
+            self.estimator.record(quality, len(raw), task.worker.elapsed)
+        if task.worker.type == "download":
+            for subscription in task.subscriptions:
+                subscription.data["download"] = True
+        else:
+            self.cache_put(DownloaderWorker.source(data, task.worker.configs, task.worker.type), raw)
+        for subscription in task.subscriptions:
+            subscription.window.get_image_finished(pixmap, subscription.uid, subscription.data, raw)
+
+    def promote(self, window, uid):  # The window waits for this download now, it gets the view bandwidth
+        for task in self.tasks.values():
+            if task.worker.traffic == "prefetch" and any(x.window is window and x.uid == uid
+                                                         for x in task.subscriptions):
+                task.worker.traffic = "view"
+                return
+
+    def terminate(self, window, type_):
+        for key, task in list(self.tasks.items()):
+            if type_ not in [task.worker.type, "all"]:
+                continue
+            mine = [x for x in task.subscriptions if x.window is window]
+            if not mine:
+                continue
+            if len(mine) == len(task.subscriptions):  # Nobody else wants it, the worker reports the stop
+                task.worker.signals.terminate.emit(type_)
+                continue
+            for subscription in mine:
+                task.subscriptions.remove(subscription)
+                window.cleanup_progress(subscription.uid)
+
+    def cache_get(self, source):
+        if source in self.cache:
+            self.cache.move_to_end(source)
+            return self.cache[source]
+        return None
+
+    def cache_put(self, source, raw):
+        if not raw or len(raw) > CACHE_BYTES // 4 or source in self.cache:
+            return
+        self.cache[source] = raw
+        self.cache_bytes += len(raw)
+        while self.cache_bytes > CACHE_BYTES:
+            _, evicted = self.cache.popitem(last=False)
+            self.cache_bytes -= len(evicted)
@@ -0,0 +1,34 @@
+AI_TAGS = ["AI", "AI 画作", "NovelAI"]
+
+
+def include_list(iter_target, iter_dest):
+    include = False
+    for i in iter_target:
+        if i in iter_dest:
+            include = True
+    return include
+
+
+def is_ai(data):  # ai_type: 0 - unknown, 1 - not AI, 2 - AI
+    if data["ai_type"] == 0:
+        return include_list(AI_TAGS, data["tags"])
+    return data["ai_type"] == 2
+
+
+def filter_records(records, configs, seen):
+    excluded_tags = set(configs["excluded_tags"])
+    excluded_authors = set(configs["excluded_authors"])
+    result = []
+    for record in records:
+        key = (record["pid"], record["p"])
+        if key in seen:  # Duplicate page
+            continue
+        if configs["ex_ai"] and is_ai(record):
+            continue
+        if include_list(record["tags"], excluded_tags):
+            continue
+        if str(record["uid"]) in excluded_authors or record["author"] in excluded_authors:
+            continue
+        seen.add(key)
+        result.append(record)
+    return result
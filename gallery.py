@@ -0,0 +1,195 @@
+from hashlib import sha1
+from json import load as j_load, JSONDecodeError
+from os import scandir, stat, remove
+from os.path import exists, join as p_join, basename, dirname, normpath, splitext
+from re import compile as re_compile
+from threading import Lock
+from time import time
+
+from configs import dump_atomic
+
+
+FILENAME_PATTERN = re_compile(r"^(\d+)-(.*) by(.*)\.(\w+)$")  # {pid}-{title} by{author}.{ext}
+IMAGE_EXTS = ["jpg", "jpeg", "png", "gif", "webp", "bmp"]
+PART_MAX_AGE = 7 * 24 * 3600  # Seconds an unfinished save is kept for resuming
+
+
+def save_filename(data):
+    return f'{data["pid"]}-{data["title"]} by{data["author"]}.{data["ext"]}'
+
+
+def save_sidecar(path, data):  # The metadata record next to the saved image
+    record = {k: data[k] for k in ["pid", "p", "title", "author", "uid", "tags", "url", "ext", "ai_type"] if k in data}
+    dump_atomic(splitext(path)[0] + ".json", record, indent=4, ensure_ascii=False)
+
+
+def part_source(part_path):  # {"url", "length", "validator"} the partial file was downloaded with, None if unknown
+    try:
+        with open(part_path + ".json", 'r', encoding='utf-8') as f:
+            return j_load(f)
+    except (OSError, JSONDecodeError, UnicodeDecodeError):
+        return None
+
+
+def save_part(part_path, buffer, source):
+    with open(part_path, 'wb') as f:
+        f.write(buffer)
+    dump_atomic(part_path + ".json", source)
+
+
+def discard_part(part_path):
+    for path in [part_path, part_path + ".json"]:
+        try:
+            remove(path)
+        except OSError:
+            pass
+
+
+def remove_stale_parts(directory):  # Unfinished saves which were not resumed for a long time
+    now = time()
+    try:
+        with scandir(directory) as it:
+            for entry in it:
+                if entry.name.endswith((".part", ".part.json")) and now - entry.stat().st_mtime > PART_MAX_AGE:
+                    remove(entry.path)
+    except OSError:
+        pass
+
+
+def parse_filename(name):
+    match = FILENAME_PATTERN.match(name)
+    if match is None or match.group(4).lower() not in IMAGE_EXTS:
+        return None
+    pid, title, author, ext = match.groups()
+    return {'pid': int(pid), 'title': title, 'uid': '', 'author': author, "tags": [], "url": {}, "ext": ext,
+            "ai_type": 0, "p": 0}
+
+
+class GalleryIndex:  # Index of the images in save_dir, rescanned incrementally by modification time
+    def __init__(self, path, profile=None):  # Per profile, the profiles may have different save_dirs
+        self.path = p_join(path, f"gallery_index-{profile}.json" if profile else "gallery_index.json")
+        self.directory = None
+        self.entries = {}  # filename -> [mtime_ns, size, record]
+        self.records = []  # Newest first
+
+    def load(self):
+        if not exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                j = j_load(f)
+            self.directory = j["directory"]
+            self.entries = j["entries"]
+        except (JSONDecodeError, UnicodeDecodeError, KeyError, TypeError, OSError):
+            self.directory = None
+            self.entries = {}
+        self.sort_records()
+
+    def save(self):
+        dump_atomic(self.path, {"directory": self.directory, "entries": self.entries}, ensure_ascii=False)
+
+    def scan(self, directory, stopped=lambda: False):  # Whether anything changed, only new or modified files are parsed
+        old = self.entries if directory == self.directory else {}
+        entries = {}
+        changed = directory != self.directory
+        with scandir(directory) as it:
+            for entry in it:
+                if stopped():  # Keep the index as it was rather than half of the directory
+                    return False
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                previous = old.get(entry.name)
+                if previous is not None and previous[0] == stat.st_mtime_ns and previous[1] == stat.st_size:
+                    entries[entry.name] = previous
+                    continue
+                record = parse_filename(entry.name)
+                if record is None:
+                    continue
+                record["path"] = entry.path
+                entries[entry.name] = [stat.st_mtime_ns, stat.st_size, record]
+                changed = True
+        if len(entries) != len(old):
+            changed = True
+        self.directory = directory
+        self.entries = entries
+        self.sort_records()
+        return changed
+
+    def sort_records(self):
+        self.records = [x[2] for x in sorted(self.entries.values(), key=lambda x: x[0], reverse=True)]
+
+
+class SaveIndex:  # Files saved into each save_dir, keyed by pid/page and by content hash
+    def __init__(self, path):
+        self.path = p_join(path, "save_index.json")
+        self.saved = {}  # save_dir -> {"pid_p": filename}
+        self.files = {}  # save_dir -> {filename: [mtime_ns, size, sha1, dhash]}, the profiles may differ in save_dir
+        self.lock = Lock()
+
+    def load(self):
+        if not exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                j = j_load(f)
+            saved, files = j["saved"], j["files"]
+        except (JSONDecodeError, UnicodeDecodeError, KeyError, TypeError, OSError):
+            return
+        if all(type(x) is dict for x in [*saved.values(), *files.values()]):  # Not from before it was per directory
+            self.saved, self.files = saved, files
+
+    def save(self):
+        with self.lock:
+            dump_atomic(self.path, {"saved": self.saved, "files": self.files}, ensure_ascii=False)
+
+    @staticmethod
+    def key(data):
+        return f'{data["pid"]}_{data["p"]}'
+
+    def file_info(self, directory, name):
+        return self.files.get(normpath(directory), {}).get(name)
+
+    def is_current(self, directory, name):  # The file still exists and was not modified since it was hashed
+        info = self.file_info(directory, name)
+        try:
+            st = stat(p_join(directory, name))
+        except OSError:
+            return False
+        return info is not None and info[0] == st.st_mtime_ns and info[1] == st.st_size
+
+    def lookup(self, data, directory):  # Path of the saved file of this page, or None
+        name = self.saved.get(normpath(directory), {}).get(self.key(data))
+        if name is not None and self.is_current(directory, name):
+            return p_join(directory, name)
+        return None
+
+    def find_hash(self, digest, directory):  # Path of a saved file with identical content, or None
+        with self.lock:
+            names = [name for name, info in self.files.get(normpath(directory), {}).items() if info[2] == digest]
+        for name in names:
+            if self.is_current(directory, name):
+                return p_join(directory, name)
+        return None
+
+    def add(self, data, path, digest, difference_hash=None):
+        st = stat(path)
+        directory, name = dirname(normpath(path)), basename(path)
+        key = self.key(data)
+        with self.lock:
+            files = self.files.setdefault(directory, {})
+            previous = files.get(name)
+            files[name] = [st.st_mtime_ns, st.st_size, digest, difference_hash]
+            saved = self.saved.setdefault(directory, {})
+            if previous is not None and previous[2] != digest:  # Overwritten, e.g. by another page of the work
+                for other in [k for k, v in saved.items() if v == name and k != key]:
+                    del saved[other]
+            saved[key] = name
+
+    def update_files(self, directory, files):
+        with self.lock:
+            self.files.setdefault(normpath(directory), {}).update(files)
+
+
+def content_hash(raw):
+    return sha1(raw).hexdigest()
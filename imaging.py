@@ -0,0 +1,254 @@
+from PyQt6.QtCore import QBuffer, QByteArray, QIODevice, QSize, Qt
+from PyQt6.QtGui import QImage, QImageReader, QImageIOHandler
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from hashlib import sha1
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+
+
+def open_reader(raw):
+    buffer = QBuffer()
+    buffer.setData(QByteArray(raw))
+    buffer.open(QIODevice.OpenModeFlag.ReadOnly)
+    reader = QImageReader(buffer)
+    return reader, buffer
+
+
+def image_size(raw):  # Only the header is parsed
+    reader, buffer = open_reader(raw)
+    size = reader.size()
+    buffer.close()
+    return size
+
+
+def decode_image(raw, size: QSize | None = None) -> QImage:
+    # Decode straight to the size it will be displayed at when the format supports it (e.g. JPEG DCT scaling)
+    reader, buffer = open_reader(raw)
+    source = reader.size()
+    if size is not None and source.isValid() and reader.supportsOption(QImageIOHandler.ImageOption.ScaledSize):
+        target = source.scaled(size, Qt.AspectRatioMode.KeepAspectRatio)
+        if target.width() < source.width() and not target.isEmpty():
+            reader.setScaledSize(target)
+    image = reader.read()
+    buffer.close()
+    if image.isNull():  # Fallback for formats QImageReader could not identify from the header
+        image = QImage.fromData(raw)
+    return image
+
+
+def transcode(raw, ext, fmt="", quality=-1, max_size=0):  # Returns (encoded bytes, ext)
+    source = image_size(raw)
+    too_large = max_size > 0 and source.isValid() and max(source.width(), source.height()) > max_size
+    same = not fmt or fmt == ext
+    recompress = fmt == ext and 0 <= quality < 100  # The format was chosen explicitly, for a smaller file
+    if same and not too_large and not recompress:  # Nothing to do, keep the original bytes
+        return raw, ext
+    size = QSize(max_size, max_size) if too_large else None
+    image = decode_image(raw, size)
+    if size is not None and (image.width() > max_size or image.height() > max_size):
+        image = image.scaled(size, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
+    target = fmt or ext
+    buffer = QBuffer()
+    buffer.open(QIODevice.OpenModeFlag.WriteOnly)
+    if image.isNull() or not image.save(buffer, target.upper(), quality):  # e.g. no WebP plugin installed
+        return raw, ext
+    encoded = buffer.data().data()
+    if same and not too_large and len(encoded) >= len(raw):  # Recompressing did not pay off
+        return raw, ext
+    return encoded, target
+
+
+def dhash(raw):  # 64-bit difference hash, near-identical images differ in few bits
+    image = decode_image(raw, QSize(64, 64))
+    if image.isNull():
+        return None
+    image = image.convertToFormat(QImage.Format.Format_Grayscale8).scaled(
+        9, 8, Qt.AspectRatioMode.IgnoreAspectRatio, Qt.TransformationMode.SmoothTransformation)
+    bits = 0
+    for y in range(8):
+        for x in range(8):
+            bits = bits << 1 | ((image.pixel(x, y) & 0xff) > (image.pixel(x + 1, y) & 0xff))
+    return bits
+
+
+def near_duplicates(hashes, distance=4):  # hashes: {name: dhash}, returns groups of names
+    # Split the hash into 8 bands of 8 bits. Any two hashes within 7 bits share at least one band exactly,
+    # so only the names bucketed together need to be compared.
+    buckets = {}
+    for name, value in hashes.items():
+        for band in range(8):
+            buckets.setdefault((band, value >> band * 8 & 0xff), []).append(name)
+    parent = {name: name for name in hashes}
+
+    def find(name):
+        while parent[name] != name:
+            parent[name] = parent[parent[name]]
+            name = parent[name]
+        return name
+
+    for names in buckets.values():
+        for i, a in enumerate(names):
+            for b in names[i + 1:]:
+                if find(a) != find(b) and bin(hashes[a] ^ hashes[b]).count("1") <= distance:
+                    parent[find(a)] = find(b)
+    groups = {}
+    for name in hashes:
+        groups.setdefault(find(name), []).append(name)
+    return [sorted(x) for x in groups.values() if len(x) > 1]
+
+
+# Optional process pool for CPU heavy image work. The encoded bytes and the decoded pixels are passed through
+# shared memory, only the block names and sizes are pickled.
+
+_process_pool = None
+POOL_ERRORS = (CancelledError, RuntimeError, BrokenProcessPool)  # The pool was shut down while a job was submitted
+
+
+def set_process_pool(enabled):
+    global _process_pool
+    if enabled and _process_pool is None:
+        _process_pool = ImageProcessPool()
+    elif not enabled and _process_pool is not None:
+        _process_pool.shutdown()
+        _process_pool = None
+
+
+def process_pool():  # The pool if enabled, otherwise None
+    return _process_pool
+
+
+# The functions below use the process pool when it is enabled, and fall back to the calling thread if it is
+# disabled, or shut down from the settings or on exit while the job is waiting in it.
+
+def decode(raw, size: QSize | None = None) -> QImage:
+    pool = _process_pool
+    if pool is not None:
+        try:
+            return pool.decode(raw, size)
+        except POOL_ERRORS:
+            pass
+    return decode_image(raw, size)
+
+
+def hash_image(raw):  # (sha1, dhash)
+    pool = _process_pool
+    if pool is not None:
+        try:
+            return pool.hash(raw)
+        except POOL_ERRORS:
+            pass
+    return sha1(raw).hexdigest(), dhash(raw)
+
+
+def transcode_images(jobs):  # jobs: [(raw, ext, fmt, quality, max_size)] -> [(raw, ext, sha1, dhash or None)]
+    pool = _process_pool
+    if pool is not None:
+        try:
+            return pool.transcode_many(jobs)
+        except POOL_ERRORS:
+            pass
+    results = []
+    for raw, *args in jobs:
+        raw, ext = transcode(raw, *args)
+        results.append((raw, ext, sha1(raw).hexdigest(), None))
+    return results
+
+
+# Parent and children share one resource tracker. Only the blocks a child creates are unregistered by it, since the
+# main process registers them again when attaching and unregisters them by unlinking. Unregistering the blocks the
+# main process created would make its unlink fail in the tracker.
+def _untrack(shm):
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except (ImportError, AttributeError, KeyError):
+        pass
+
+
+def _read_shared(name, size):
+    shm = SharedMemory(name=name)  # Created and unlinked by the main process, left registered
+    try:
+        return bytes(shm.buf[:size])
+    finally:
+        shm.close()
+
+
+def _decode_task(name, size, width, height):
+    image = decode_image(_read_shared(name, size), QSize(width, height) if width > 0 else None)
+    if image.isNull():
+        return None
+    image = image.convertToFormat(QImage.Format.Format_ARGB32)
+    bits = image.constBits()
+    bits.setsize(image.sizeInBytes())
+    out = SharedMemory(create=True, size=image.sizeInBytes())
+    _untrack(out)
+    out.buf[:image.sizeInBytes()] = bits.asstring()
+    out.close()
+    return out.name, image.width(), image.height(), image.bytesPerLine(), image.sizeInBytes()
+
+
+def _hash_task(name, size):
+    raw = _read_shared(name, size)
+    return sha1(raw).hexdigest(), dhash(raw)
+
+
+def _transcode_task(name, size, ext, fmt, quality, max_size):
+    raw, ext = transcode(_read_shared(name, size), ext, fmt, quality, max_size)
+    out = SharedMemory(create=True, size=max(len(raw), 1))
+    _untrack(out)
+    out.buf[:len(raw)] = raw
+    out.close()
+    return out.name, len(raw), ext, sha1(raw).hexdigest(), dhash(raw)
+
+
+class ImageProcessPool:
+    def __init__(self, workers=None):
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"))
+
+    def run(self, function, raw, *args):  # Blocks the calling worker thread, not the GUI
+        return self.run_many(function, [(raw, *args)])[0]
+
+    def run_many(self, function, jobs):  # jobs: [(raw, *args)], run concurrently across the processes
+        blocks = []
+        try:
+            futures = []
+            for raw, *args in jobs:
+                shm = SharedMemory(create=True, size=max(len(raw), 1))
+                blocks.append(shm)
+                shm.buf[:len(raw)] = raw
+                futures.append(self.executor.submit(function, shm.name, len(raw), *args))
+            return [future.result() for future in futures]
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+    def decode(self, raw, size: QSize | None = None) -> QImage:
+        result = self.run(_decode_task, raw, *((size.width(), size.height()) if size is not None else (0, 0)))
+        if result is None:
+            return QImage()
+        name, width, height, bytes_per_line, length = result
+        shm = SharedMemory(name=name)
+        try:
+            return QImage(bytes(shm.buf[:length]), width, height, bytes_per_line, QImage.Format.Format_ARGB32).copy()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def hash(self, raw):  # (sha1, dhash)
+        return self.run(_hash_task, raw)
+
+    def transcode_many(self, jobs):  # jobs: [(raw, ext, fmt, quality, max_size)] -> [(raw, ext, sha1, dhash)]
+        results = []
+        for name, length, ext, digest, difference_hash in self.run_many(_transcode_task, jobs):
+            shm = SharedMemory(name=name)
+            try:
+                results.append((bytes(shm.buf[:length]), ext, digest, difference_hash))
+            finally:
+                shm.close()
+                shm.unlink()
+        return results
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -1,30 +1,46 @@
 import sys
+from os import _exit
+from math import ceil
+from time import perf_counter
 from uuid import uuid4
-from PyQt6.QtCore import Qt, QThreadPool, pyqtSignal, QTimer
-from PyQt6.QtGui import QAction, QIcon
+from PyQt6.QtCore import Qt, pyqtSignal, QTimer, QFileSystemWatcher
+from PyQt6.QtGui import QAction, QIcon, QPixmap
 from PyQt6.QtWidgets import (QApplication, QWidget, QMainWindow, QPushButton, QVBoxLayout, QHBoxLayout, QSizePolicy,
-                             QMessageBox)
+                             QMessageBox, QInputDialog, QFileDialog)
 from os.path import join as p_join, dirname
 from sys import platform
 
-from widgets import PixmapLabel, TaskViewWindow, SettingsDialog, WaitForTaskDialog, DetailDialog
-from configs import load_config, save_settings
-from threads import GetPictureURLsWorker, DownloaderWorker
+from widgets import PixmapLabel, TaskViewWindow, SettingsDialog, WaitForTaskDialog, DetailDialog, HistoryModel, \
+    FilmStrip, SearchDialog
+from configs import load_config, save_settings, save_queue, valid_profile
+from engine import DownloadEngine, JUMP_PRIORITY, VIEW_PRIORITY, SAVE_PRIORITY, QUALITIES
+from threads import GetPictureURLsWorker, RestoreQueueWorker, GalleryScanWorker, DedupeWorker, SaveWorker, \
+    DecodeWorker, PartCleanupWorker
+from gallery import GalleryIndex, save_filename
+from imaging import decode, set_process_pool
+from network import in_flight
+from tracing import record as trace_record, export as export_trace
+from objects import AppState
 
 
 PATH = dirname(__file__)
+SAVE_BATCH = 8  # Saves arriving together are handed to one SaveWorker, up to this many each
+DECODED_WINDOW = 2  # History entries further than this from the current one are kept encoded only
+MAX_LOOKAHEAD = 20  # Images prefetched at most in the slideshow, however slow the connection is
+HISTORY_BYTES = 256 * 1024 * 1024  # Encoded bytes kept in the history, the oldest entries beyond are dropped
 
 
 class MainWindow(QMainWindow):  # MainWindow class definition
     term_signal = pyqtSignal(str)
-    update_image_urls_signal = pyqtSignal(int)
+    update_image_urls_signal = pyqtSignal(int, int)  # URLs queued, URLs wanted
 
-    def __init__(self):
+    def __init__(self, profile=None):
         super().__init__()
-        self.configs = load_config(p_join(PATH), self)
+        self.profile = profile  # Settings and queue are kept per profile, None for the default one
+        self.configs = load_config(p_join(PATH), self, profile)
         self.setWindowIcon(QIcon(p_join(PATH, 'favicon.ico')))  # Set window icon
 
-        self.setWindowTitle('LSP Viewer')
+        self.setWindowTitle('LSP Viewer - ' + profile if profile else 'LSP Viewer')
         self.container = QWidget(self)  # Container Widget
         self.setCentralWidget(self.container)
         self.container.setLayout(QVBoxLayout())
@@ -35,31 +51,61 @@ class MainWindow(QMainWindow):  # MainWindow class definition
 
         self.resize(500, 650)
 
-        self.thread_pool = QThreadPool()
-        self.thread_pool_for_save = QThreadPool()
+        self.engine = DownloadEngine.instance()  # Downloads, cache and thread pool shared by every window
+        self.engine.register(self, PATH)
+        self.thread_pool = self.engine.thread_pool
+        self.background_pool = self.engine.background_pool
 
-        self.images = []  # A List for storing QPixmap
-        self.image_data = []  # A List for storing picture download URL
-        self.previous_images = []
+        self.state = AppState(self)  # images, image_data, progresses and the getting_url flag
+        self.previous_images = []  # (pixmap or None when not decoded, data, encoded bytes), newest first
+        self.decoding = set()  # id() of the history data being decoded ahead
         self.previous_image_index = 0
         self.current_image = None  # Current displaying image variable
-        self.getting_url = False  # A flag for checking whether the GET URL THREAD is running
-        self.progresses_getimage = {}
-        self.progresses_saveimage = {}
-
-        self.timer = QTimer()
-        self.timer.setInterval(100)
-        self.timer.timeout.connect(self.refresh_image)
-        self.timer.start()
+        self.detached_entry = None  # A history entry jumped to from the filmstrip which is out of previous_images
+        self.history = HistoryModel(self)  # Metadata of every viewed image, for the filmstrip
+        self.seen_pages = set()  # (pid, p) of every page fetched, for dropping duplicates
+        self.queued_at = {}  # History key -> perf_counter() when it was queued, for the trace
+        self.trace_uids = {}  # History key -> uid of the task which fetched it, until displayed
+        self.preview = None  # (uid, pixmap) of the partly downloaded image shown while nothing else can be
+
+        self.offline = False  # Browsing the images in save_dir instead of the API
+        self.scanning = False
+        self.gallery = GalleryIndex(PATH, profile)
+        self.gallery.load()
+        self.gallery_queued = set()  # Paths of the gallery images already queued in this round
+        self.gallery_watcher = QFileSystemWatcher()
+        self.gallery_watcher.directoryChanged.connect(lambda _: self.rescan_timer.start())
+        self.rescan_timer = QTimer()  # Coalesce bursts of directory changes into one rescan
+        self.rescan_timer.setSingleShot(True)
+        self.rescan_timer.setInterval(500)
+        self.rescan_timer.timeout.connect(self.scan_gallery)
+
+        self.save_index = self.engine.save_index  # For skipping the works already saved
+        self.pending_saves = []  # (encoded bytes, data) waiting for the next SaveWorker batch
+
+        self.slideshow_timer = QTimer()  # Advances the slideshow, restarted when a late slide arrives
+        self.slideshow_timer.setInterval(self.configs["slideshow_interval"] * 1000)
+        self.slideshow_timer.timeout.connect(self.slideshow_tick)
+        self.slideshow = False
+        self.slide_late = None  # perf_counter() of the deadline the current slide missed
+        self.slideshow_stats = {"shown": 0, "late": 0, "stalled": 0.0, "downgraded": 0}
 
         self.task_viewer = TaskViewWindow(self)
         self.settings_dialog = SettingsDialog(self, PATH)
         self.close_waiter = WaitForTaskDialog(self)
         self.detail_dialog = DetailDialog(self, PATH)
+        self.search_dialog = SearchDialog(self)
 
         self.__init_widgets()
         self.__init_menubar()
 
+        self.refresh_pending = False
+        for signal in [self.state.images_changed, self.state.progress_changed, self.state.progress_removed,
+                       self.state.getting_url_changed]:
+            signal.connect(self.schedule_refresh)
+
+        QTimer.singleShot(0, self.restore_queue)  # Once shown, so that the label has its real size to decode at
+
     def __init_widgets(self):
         self.image = PixmapLabel(self)
         self.image.setText("Here shows images.")
@@ -68,6 +114,11 @@ class MainWindow(QMainWindow):  # MainWindow class definition
         self.image.setStatusTip("Here showing the images. If no images present the only text displays.")
         self.container.layout().addWidget(self.image)
 
+        self.filmstrip = FilmStrip(self.history)
+        self.filmstrip.setStatusTip("History of viewed images. Click one to display it.")
+        self.filmstrip.clicked.connect(lambda index: self.show_history_entry(index.row()))
+        self.container.layout().addWidget(self.filmstrip)
+
         self.button_layout = QHBoxLayout()
         self.button_layout.setAlignment(Qt.AlignmentFlag.AlignHCenter | Qt.AlignmentFlag.AlignTop)
         self.btn_prev = QPushButton('<<Previous')
@@ -97,6 +148,17 @@ class MainWindow(QMainWindow):  # MainWindow class definition
         self.action_save.triggered.connect(self.save_image)
         self.file_menu.addAction(self.action_save)
 
+        self.action_new_window = QAction('New &Window...', self)
+        self.action_new_window.setShortcut('Ctrl+N')
+        self.action_new_window.setStatusTip('Open another viewer window with a separate profile.')
+        self.action_new_window.triggered.connect(self.new_window)
+        self.file_menu.addAction(self.action_new_window)
+
+        self.action_export_trace = QAction('Export &Trace...', self)
+        self.action_export_trace.setStatusTip('Save the timeline of the recent tasks for a trace viewer.')
+        self.action_export_trace.triggered.connect(self.export_trace)
+        self.file_menu.addAction(self.action_export_trace)
+
         self.file_menu.addSeparator()
 
         self.action_previous = QAction('&Previous', self)
@@ -117,6 +179,38 @@ class MainWindow(QMainWindow):  # MainWindow class definition
         self.action_detail.triggered.connect(self.show_detail)
         self.file_menu.addAction(self.action_detail)
 
+        self.action_show_filmstrip = QAction("Show Filmstrip", self)
+        self.action_show_filmstrip.setShortcut('Ctrl+H')
+        self.action_show_filmstrip.setCheckable(True)
+        self.action_show_filmstrip.setChecked(True)
+        self.action_show_filmstrip.toggled.connect(self.filmstrip.setVisible)
+        self.function_menu.addAction(self.action_show_filmstrip)
+
+        self.action_offline = QAction("Offline Gallery", self)
+        self.action_offline.setShortcut('Ctrl+O')
+        self.action_offline.setCheckable(True)
+        self.action_offline.setStatusTip('Browse the images in the save directory instead of fetching new ones.')
+        self.action_offline.toggled.connect(self.toggle_offline)
+        self.function_menu.addAction(self.action_offline)
+
+        self.action_slideshow = QAction("Slideshow", self)
+        self.action_slideshow.setShortcut('F5')
+        self.action_slideshow.setCheckable(True)
+        self.action_slideshow.setStatusTip('Advance to the next image automatically, see the interval in the settings.')
+        self.action_slideshow.toggled.connect(self.toggle_slideshow)
+        self.function_menu.addAction(self.action_slideshow)
+
+        self.action_dedupe = QAction("Find Duplicates", self)
+        self.action_dedupe.setStatusTip('Find identical or nearly identical images in the save directory.')
+        self.action_dedupe.triggered.connect(self.find_duplicates)
+        self.function_menu.addAction(self.action_dedupe)
+
+        self.action_search = QAction("Search Fetched Images...", self)
+        self.action_search.setShortcut('Ctrl+F')
+        self.action_search.setStatusTip('Search every image fetched so far by tag, author or uid.')
+        self.action_search.triggered.connect(self.search_dialog.show)
+        self.function_menu.addAction(self.action_search)
+
         self.action_show_task_view = QAction("Show TaskViewer", self)
         self.action_show_task_view.setShortcut('Ctrl+T')
         self.action_show_task_view.triggered.connect(self.task_viewer.show)
@@ -128,105 +222,337 @@ class MainWindow(QMainWindow):  # MainWindow class definition
         self.function_menu.addAction(self.action_show_settings_dialog)
 
     def closeEvent(self, a0):
-        if self.progresses_saveimage:
+        self.flush_saves()  # The saves still waiting for a batch are saving work too
+        if self.state.progresses_saveimage:
             r = QMessageBox.warning(self, 'Warning', 'There are Saving work in the background.\n'
                                     'Are you sure to exit now?',
                                     QMessageBox.StandardButton.No | QMessageBox.StandardButton.Yes,
                                     QMessageBox.StandardButton.No)
             if r == QMessageBox.StandardButton.No:
                 return a0.ignore()
+        start = perf_counter()
         self.task_viewer.close()
-        self.close_waiter.timer.start()
         self.close_waiter.exec()
-        save_settings(PATH, self.configs)
+        save_settings(PATH, self.configs, self.profile)
+        if not self.offline:
+            try:
+                save_queue(PATH, self.configs, self.state.image_data, self.state.images, self.profile)
+            except OSError as e:  # e.g. a directory in the cache, the queue is only lost
+                print("Saving the queue failed:", e, flush=True)
+        last = not self.engine.unregister(self)  # The other windows keep the engine running
+        finished = True
+        if last:
+            self.thread_pool.clear()  # Drop the downloads not started yet
+            # The background workers were stopped too and give up at the next file, whatever is left of the deadline
+            remaining = self.configs["shutdown_timeout"] * 1000 - (perf_counter() - start) * 1000
+            finished = self.background_pool.waitForDone(max(int(remaining), 0))
+        self.save_index.save()
+        self.engine.tag_index.save()
+        if not last:
+            print("Window closed in %.2fs" % (perf_counter() - start), flush=True)
+            return super().closeEvent(a0)
+        set_process_pool(False)
+        print("Shutdown took %.2fs" % (perf_counter() - start), flush=True)
+        if not finished or self.thread_pool.activeThreadCount() or in_flight():
+            _exit(0)  # Do not let the exit wait for the requests blocked in connecting or a job past the deadline
         super().closeEvent(a0)
 
+    def new_window(self):
+        profile, ok = QInputDialog.getText(self, "New Window", "Profile name (empty for the default one):")
+        if not ok:
+            return
+        profile = profile.strip() or None
+        if profile is not None and not valid_profile(profile):
+            return QMessageBox.warning(self, "Warning", "Profile names may only contain letters, digits, '-' and '_'.")
+        if any(x.profile == profile for x in self.engine.windows):
+            return QMessageBox.warning(self, "Warning", "A window of this profile is already open.")
+        MainWindow(profile).show()
+
     def save_image(self):
         if self.current_image is not None:
-            data = self.previous_images[self.previous_image_index][1]
-            if self.configs["view_quality"] != self.configs["save_quality"]:
-                uid = "Save:" + uuid4().hex
-                worker = DownloaderWorker(data, uid, self.configs, "download")
-                self.update_progress(uid, 0)
-                self.term_signal.connect(worker.signals.terminate)
-                worker.signals.progress.connect(self.update_progress)
-                worker.signals.error.connect(self.deal_errors)
-                worker.signals.stop.connect(self.cleanup_progress)
-                worker.signals.finish_download.connect(self.get_image_finished)
-                self.thread_pool_for_save.start(worker)
+            data = self.current_entry()[1]
+            if data.get("path"):
+                return QMessageBox.information(self, "Info", "The image is already in the save directory.\n"
+                                               "Filename:\n" + data["path"])
+            saved = self.save_index.lookup(data, self.configs["save_dir"])
+            if saved is not None:
+                return QMessageBox.information(self, "Info", "The image has already been saved.\n"
+                                               "Filename:\n" + saved)
+            pixmap, _, raw = self.current_entry()
+            # A jump still showing the thumbnail or a preview has no encoded bytes of the image yet
+            if self.configs["view_quality"] != self.configs["save_quality"] or raw is None:
+                self.engine.download(self, data, "Save:" + uuid4().hex, self.configs, "download",
+                                     priority=SAVE_PRIORITY)
             else:
                 data["download"] = True
-                self.get_image_finished(self.previous_images[self.previous_image_index][0], 0, data)
+                self.get_image_finished(pixmap, "", data, raw)
             QMessageBox.information(self, "Info", "Started download in the background.\n"
-                                    "Filename:\n" +
-                                    p_join(self.configs["save_dir"], f'{data["pid"]}-{data["title"]} by'
-                                                                     f'{data["author"]}.{data["ext"]}')
-                                    )
+                                    "Filename:\n" + self.save_path(data))
         else:
             QMessageBox.warning(self, "Warning", "No images present now.")
 
     def get_images(self):
-        if self.images and self.previous_image_index == 0:
-            self.previous_images.insert(0, self.images.pop(0))
-            self.current_image = self.previous_images[0][0]
-            while len(self.previous_images) > self.configs["keep_num"] + 1:
-                self.previous_images.pop()
+        self.detached_entry = None
+        if self.state.images and self.previous_image_index == 0:
+            self.push_history(self.state.pop_image())
         elif self.previous_image_index > 0:
-            self.previous_image_index -= 1
-            self.current_image = self.previous_images[self.previous_image_index][0]
+            self.show_previous(self.previous_image_index - 1)
         else:
             self.current_image = None
-        if self.image_data:
+        self.request_images()
+        self.filmstrip.select_row(len(self.history.records) - 1 - self.previous_image_index)
+        self.refresh_image()
+
+    def request_images(self):  # Download the queued ones and fetch more URLs, without changing the image shown
+        if self.state.image_data:
             self.start_download_worker()
-        if len(self.image_data) <= self.configs.get('cache_num') and not self.getting_url:
+        if self.offline:
+            self.update_gallery_urls()
+        elif len(self.state.image_data) <= self.prefetch_target() and not self.state.getting_url:
             print("Start GET URL Thread")
-            self.getting_url = True
-            worker = GetPictureURLsWorker(self.configs, len(self.image_data))
+            self.state.getting_url = True
+            worker = GetPictureURLsWorker(self.configs, len(self.state.image_data), self.seen_pages,
+                                          self.prefetch_target())
             self.update_image_urls_signal.connect(worker.signals.update_url_count)
             worker.signals.error.connect(self.deal_errors)
             worker.signals.return_urls.connect(self.update_image_urls)
             worker.signals.finish_geturl.connect(self.get_url_finished)
-            self.thread_pool.start(worker)
+            worker.signals.stop.connect(self.get_url_stopped)
+            self.term_signal.connect(worker.signals.terminate)
+            self.background_pool.start(worker, VIEW_PRIORITY)
+
+    def toggle_offline(self, checked):
+        self.term_signal.emit("fetch")
+        self.clear_queue()
+        self.gallery_queued.clear()
+        self.offline = checked
+        self.watch_gallery()
+
+    def clear_queue(self):
+        for data in self.state.image_data + [x[1] for x in self.state.images]:  # Allow them to come back
+            self.seen_pages.discard((data["pid"], data["p"]))
+        self.state.clear_images()
+        self.state.clear_image_data()
+
+    def watch_gallery(self):  # Also called when save_dir is changed in the settings
+        if self.gallery_watcher.directories():
+            self.gallery_watcher.removePaths(self.gallery_watcher.directories())
+        if self.offline:
+            self.gallery_queued.clear()
+            self.gallery_watcher.addPath(self.configs["save_dir"])
+            self.scan_gallery()
+            self.update_gallery_urls()  # Show what the index already knows while rescanning
+
+    def scan_gallery(self):
+        if self.scanning:
+            return self.rescan_timer.start()
+        self.scanning = True
+        worker = GalleryScanWorker(self.gallery, self.configs["save_dir"])
+        worker.signals.finish_scan.connect(self.scan_gallery_finished)
+        self.term_signal.connect(worker.signals.terminate)
+        self.background_pool.start(worker, VIEW_PRIORITY)
+        self.refresh_image()
+
+    def scan_gallery_finished(self, changed):
+        self.scanning = False
+        if self.offline and changed:
+            self.update_gallery_urls()
+        self.refresh_image()
+
+    def update_gallery_urls(self):
+        if self.gallery.directory != self.configs["save_dir"]:
+            return
+        records = []
+        for record in self.gallery.records:
+            if len(self.state.image_data) + len(records) > self.prefetch_target():
+                break
+            if record["path"] not in self.gallery_queued:
+                self.gallery_queued.add(record["path"])
+                records.append(record)
+        self.state.add_image_data(records)
+        if not self.state.image_data and not self.state.images and not self.state.progresses_getimage and \
+                not self.scanning and self.current_image is None:
+            self.deal_errors("no_local_pic")
+        self.start_download_worker()
+
+    def push_history(self, entry):
+        self.previous_images.insert(0, entry)
+        self.current_image = entry[0]
+        while len(self.previous_images) > self.configs["keep_num"] + 1:
+            self.previous_images.pop()
+        kept = 0
+        for i, (_, _, raw) in enumerate(self.previous_images):  # Originals can be tens of MB each
+            kept += len(raw) if raw else 0
+            if kept > HISTORY_BYTES and i > self.previous_image_index:
+                del self.previous_images[i:]
+                break
+        self.trim_history()
+        self.history.append(entry[1])
+        self.filmstrip.select_row(len(self.history.records) - 1)
+
+    def show_previous(self, index):  # Decode here only if the background decode has not got there yet
+        self.previous_image_index = index
+        pixmap, data, raw = self.previous_images[index]
+        if pixmap is None:
+            pixmap = QPixmap.fromImage(decode(raw, self.image.target_size()))
+            self.previous_images[index] = (pixmap, data, raw)
+        self.current_image = pixmap
+        self.trim_history()
+
+    def trim_history(self):  # Drop the pixmaps far from the current entry and decode the ones around it ahead
+        for i, (pixmap, data, raw) in enumerate(self.previous_images):
+            if abs(i - self.previous_image_index) <= DECODED_WINDOW:
+                if pixmap is None and id(data) not in self.decoding:
+                    self.decoding.add(id(data))
+                    worker = DecodeWorker(data, raw, self.image.target_size())
+                    worker.signals.finish_decode.connect(self.decode_finished)
+                    self.thread_pool.start(worker, VIEW_PRIORITY)
+            elif pixmap is not None and raw:  # Entries without the encoded bytes cannot be decoded again
+                self.previous_images[i] = (None, data, raw)
+
+    def decode_finished(self, data, image):
+        self.decoding.discard(id(data))
+        for i, (pixmap, x, raw) in enumerate(self.previous_images):
+            if x is data:
+                if pixmap is None and not image.isNull() and abs(i - self.previous_image_index) <= DECODED_WINDOW:
+                    self.previous_images[i] = (QPixmap.fromImage(image), data, raw)
+                break
+
+    def current_entry(self):
+        if self.detached_entry is not None:
+            return self.detached_entry
+        return self.previous_images[self.previous_image_index]
+
+    def show_history_entry(self, row):
+        back = len(self.history.records) - 1 - row  # Steps back from the newest one
+        if back < len(self.previous_images):  # Still kept, show it directly
+            self.detached_entry = None
+            self.show_previous(back)
+            return self.refresh_image()
+        self.show_record(self.history.records[row])
+
+    def show_record(self, record):  # Show any record out of previous_images, e.g. a search result
+        row = self.history.rows.get(self.history.key(record))
+        if row is not None and len(self.history.records) - 1 - row < len(self.previous_images):
+            return self.show_history_entry(row)
+        thumbnail = self.history.thumbnail(record)
+        if thumbnail is None:
+            thumbnail = self.history.placeholder
+        self.detached_entry = (thumbnail, record, None)  # Show the thumbnail until the full image arrives
+        self.current_image = thumbnail
+        self.engine.download(self, record, "Jump:" + uuid4().hex, self.configs, size=self.image.target_size(),
+                             priority=JUMP_PRIORITY)
+        self.refresh_image()
 
     def get_previous_image(self):
-        if self.current_image is None and self.previous_images:
-            self.current_image = self.previous_images[self.previous_image_index][0]
+        if self.detached_entry is not None:
+            self.detached_entry = None
+            self.show_previous(self.previous_image_index)
+        elif self.current_image is None and self.previous_images:
+            self.show_previous(self.previous_image_index)
         elif self.previous_image_index + 1 >= len(self.previous_images):
             return self.deal_errors("no_previous_pic")
         else:
-            self.previous_image_index += 1
-            self.current_image = self.previous_images[self.previous_image_index][0]
+            self.show_previous(self.previous_image_index + 1)
+        self.filmstrip.select_row(len(self.history.records) - 1 - self.previous_image_index)
+        self.refresh_image()
 
     def start_download_worker(self):
-        while len(self.images) + len(self.progresses_getimage) < self.configs.get('cache_num') and self.image_data:
+        while len(self.state.images) + len(self.state.progresses_getimage) < self.prefetch_target() and \
+                self.state.image_data:
+            waiting = self.current_image is None and not self.state.images  # Nothing to show until it arrives
+            data = self.state.pop_image_data()
             uid = uuid4().hex
-            worker = DownloaderWorker(self.image_data.pop(0), uid, self.configs)
-            self.update_progress(uid, 0)
-            self.term_signal.connect(worker.signals.terminate)
-            worker.signals.progress.connect(self.update_progress)
-            worker.signals.error.connect(self.deal_errors)
-            worker.signals.finish_download.connect(self.get_image_finished)
-            worker.signals.stop.connect(self.cleanup_progress)
-            self.thread_pool.start(worker)
+            queued = self.queued_at.pop(self.history.key(data), None)
+            if queued is not None:
+                trace_record("queue wait", uid, queued)
+            configs = self.configs
+            if self.slideshow and not data.get("path"):
+                quality = self.slide_quality(data, len(self.state.images) + len(self.state.progresses_getimage))
+                if quality != configs["view_quality"]:
+                    configs = {**configs, "view_quality": quality}
+                    self.slideshow_stats["downgraded"] += 1
+            self.engine.download(self, data, uid, configs, size=self.image.target_size(),
+                                 traffic="view" if waiting else "prefetch")
+
+    def prefetch_target(self):  # In the slideshow, enough images to cover the time one takes to download
+        if not self.slideshow:
+            return self.configs.get('cache_num')
+        fetch_time = self.engine.estimator.estimate(self.configs["view_quality"])
+        lookahead = ceil(fetch_time / self.configs["slideshow_interval"]) + 1
+        return max(self.configs.get('cache_num'), min(lookahead, MAX_LOOKAHEAD))
+
+    def slide_quality(self, data, slot):  # The best quality which arrives before the slide is due
+        deadline = max(self.slideshow_timer.remainingTime(), 0) / 1000 + slot * self.configs["slideshow_interval"]
+        qualities = QUALITIES[QUALITIES.index(self.configs["view_quality"]):]
+        for quality in qualities:
+            if data["url"].get(quality) and self.engine.estimator.estimate(quality) <= deadline:
+                return quality
+        return next((x for x in reversed(qualities) if data["url"].get(x)), self.configs["view_quality"])
+
+    def toggle_slideshow(self, checked):
+        self.slideshow = checked
+        self.slide_late = None
+        if checked:
+            self.slideshow_stats = {"shown": 0, "late": 0, "stalled": 0.0, "downgraded": 0}
+            self.slideshow_timer.start()
+            self.start_download_worker()
+        else:
+            self.slideshow_timer.stop()
+            self.show_slideshow_stats()
+
+    def slideshow_tick(self):
+        if self.slide_late is None and (self.state.images or self.previous_image_index > 0):
+            self.slideshow_stats["shown"] += 1
+            self.get_images()
+            return self.show_slideshow_stats()
+        if self.slide_late is None:  # Late, show the next image as soon as it arrives
+            self.slide_late = perf_counter()
+            self.slideshow_stats["late"] += 1
+        if not (self.state.progresses_getimage or self.state.image_data or self.state.getting_url or
+                self.scanning):  # Nothing on the way, e.g. the download waited for has failed
+            self.request_images()
+        self.show_slideshow_stats()
+
+    def show_slideshow_stats(self):
+        stats = self.slideshow_stats
+        self.statusbar.showMessage("Slideshow: %d shown, %d late, stalled for %.1fs, %d at a lower quality" % (
+            stats["shown"], stats["late"], stats["stalled"], stats["downgraded"]))
 
     def update_progress(self, uid, progress):
-        if uid[:4] == "Save":
-            self.progresses_saveimage[uid] = progress
-        else:
-            self.progresses_getimage[uid] = progress
+        self.state.set_progress(uid, progress)
+
+    def schedule_refresh(self):  # A burst of state changes, e.g. the progress of every chunk, is one refresh
+        if not self.refresh_pending:
+            self.refresh_pending = True
+            QTimer.singleShot(0, self.refresh_image)
 
     def refresh_image(self):
+        self.refresh_pending = False
+        if self.current_image is None and self.state.images:
+            self.push_history(self.state.pop_image())
+        if self.current_image is None and self.state.progresses_getimage:  # The oldest one is shown next
+            self.engine.promote(self, next(iter(self.state.progresses_getimage)))
         if self.current_image:
-            self.image.set_original_pixmap(self.current_image)
-        elif self.current_image is None and self.images:
-            self.previous_images.insert(0, self.images.pop(0))
-            self.current_image = self.previous_images[0][0]
-        elif self.progresses_getimage:
+            pixmap, data, raw = self.current_entry()
+            uid = self.trace_uids.pop(self.history.key(data), None) if self.current_image is not \
+                self.image.source_pixmap else None
+            start = perf_counter()
+            self.image.set_original_pixmap(self.current_image, raw, uid)
+            if uid is not None:
+                trace_record("display", uid, start)
+        elif self.preview is not None and self.preview[0] in self.state.progresses_getimage:
+            self.image.set_original_pixmap(self.preview[1])
+        elif self.state.progresses_getimage:
             self.image.set_original_pixmap(None)
-            max_id, max_progress = max(self.progresses_getimage.items(), key=lambda x: x[1])
-            self.image.setText("Fastest worker id: %s\nProgress: %.2f%%" % (max_id, max_progress))
-        elif self.getting_url:
+            max_id, max_progress = max(self.state.progresses_getimage.items(), key=lambda x: x[1])
+            text = "Fastest worker id: %s\nProgress: %.2f%%" % (max_id, max_progress)
+            if self.image.text() != text:
+                self.image.setText(text)
+        elif self.state.getting_url:
             self.image.setText("Fetching URLs. Please wait...")
+        elif self.offline and self.scanning:
+            self.image.setText("Scanning the save directory. Please wait...")
         else:
             self.image.set_original_pixmap(None)
             self.image.setText("Here shows images.")
@@ -237,7 +563,7 @@ class MainWindow(QMainWindow):  # MainWindow class definition
                 QMessageBox.warning(self, 'Error', 'There was an error when fetching the urls of pictures.'
                                     '\nPlease check your Internet connection.'
                                     '\nPress the "Next" button to retry.')
-            self.getting_url = False
+            self.state.getting_url = False
         elif error == "get_pic_failed":
             if not self.configs["suppress_warnings"]:
                 QMessageBox.information(self, 'Error', 'There was an error when fetching the pictures.\n'
@@ -252,38 +578,138 @@ class MainWindow(QMainWindow):  # MainWindow class definition
             if not self.configs["suppress_warnings"]:
                 QMessageBox.warning(self, 'Error', "There's NO MORE picture related to the specific tag(s) or"
                                     " artist(s).\nPlease change the tags filter in the settings.")
-            self.getting_url = False
+            self.state.getting_url = False
+            self.action_slideshow.setChecked(False)  # Nothing more to show, do not ask again on every tick
+        elif error == "no_local_pic":
+            if not self.configs["suppress_warnings"]:
+                QMessageBox.warning(self, 'Error', "There's NO MORE picture in the save directory.")
+            self.action_slideshow.setChecked(False)
         elif error == "no_previous_pic" and not self.configs["suppress_warnings"]:
             QMessageBox.warning(self, 'Error', "No more previous picture.")
 
     def update_image_urls(self, urls):  # Extend the image_url list, then return the current url count to the sub-thread
-        self.image_data.extend(urls)
-        self.update_image_urls_signal.emit(len(self.image_data))
+        if self.offline:  # Stop a worker started before switching to the offline gallery
+            return self.update_image_urls_signal.emit(1, 0)
+        self.engine.tag_index.add(urls)
+        now = perf_counter()
+        for data in urls:
+            self.queued_at[self.history.key(data)] = now
+        self.state.add_image_data(urls)
+        self.update_image_urls_signal.emit(len(self.state.image_data), self.prefetch_target())
+
+    def restore_queue(self):
+        worker = RestoreQueueWorker(PATH, self.configs, self.image.target_size(), self.profile)
+        worker.signals.restore_queue.connect(self.restore_queue_finished)
+        self.background_pool.start(worker, VIEW_PRIORITY)
+        self.background_pool.start(PartCleanupWorker(self.configs["save_dir"]), SAVE_PRIORITY)
+
+    def restore_queue_finished(self, image_data, images):  # Put the queue of the last session in front
+        for data in image_data + [x[1] for x in images]:
+            self.seen_pages.add((data["pid"], data["p"]))
+        self.state.add_image_data(image_data, front=True)
+        self.state.add_images(images, front=True)
 
     def get_url_finished(self):
-        self.getting_url = False
+        self.state.getting_url = False
         self.start_download_worker()
 
-    def cleanup_progress(self, uid):
-        if uid in self.progresses_getimage.keys():
-            self.progresses_getimage.pop(uid)
-        if uid in self.progresses_saveimage.keys():
-            self.progresses_saveimage.pop(uid)
+    def get_url_stopped(self, uid):
+        self.state.getting_url = False
 
-    def get_image_finished(self, pixmap, uid, details):
-        if details.get("download"):
+    def cleanup_progress(self, uid):
+        if self.preview is not None and self.preview[0] == uid:
+            self.preview = None
+        self.state.remove_progress(uid)
+
+    def show_preview(self, uid, data, image):  # A partial decode of the image the user is waiting for
+        pixmap = QPixmap.fromImage(image)
+        if uid[:4] == "Jump":
+            if self.detached_entry is not None and self.detached_entry[1] is data and self.detached_entry[2] is None:
+                self.detached_entry = (pixmap, data, None)
+                self.current_image = pixmap
+                self.refresh_image()
+        elif self.current_image is None:
+            self.preview = (uid, pixmap)
+            self.refresh_image()
+
+    def get_image_finished(self, pixmap, uid, details, raw=None):
+        if uid[:4] == "Jump":
             self.cleanup_progress(uid)
-            pixmap.save(p_join(self.configs["save_dir"], f'{details["pid"]}-{details["title"]} by'
-                                                         f'{details["author"]}.{details["ext"]}'))
+            if self.detached_entry is not None and self.detached_entry[1] is details:
+                self.trace_uids[self.history.key(details)] = uid
+                self.detached_entry = (pixmap, details, raw)
+                self.current_image = pixmap
+                self.refresh_image()
+        elif details.get("download"):
+            self.cleanup_progress(uid)
+            if raw:
+                self.queue_save(raw, details)
+            else:
+                pixmap.save(self.save_path(details))
         else:
             self.cleanup_progress(uid)
-            self.images.append((pixmap, details))
+            self.trace_uids[self.history.key(details)] = uid
+            self.state.add_images([(pixmap, details, raw)])
+            if self.slide_late is not None:  # The slide due is here, show it and restart the interval
+                self.slideshow_stats["stalled"] += perf_counter() - self.slide_late
+                self.slide_late = None
+                self.slideshow_stats["shown"] += 1
+                self.get_images()
+                self.slideshow_timer.start()
+                self.show_slideshow_stats()
             self.start_download_worker()
 
+    def save_path(self, data):
+        return p_join(self.configs["save_dir"], save_filename({**data, "ext": self.configs["save_format"] or
+                                                               data["ext"]}))
+
+    def queue_save(self, raw, data):
+        self.pending_saves.append((raw, data))
+        if len(self.pending_saves) == 1:
+            QTimer.singleShot(0, self.flush_saves)
+
+    def flush_saves(self):
+        jobs, self.pending_saves = self.pending_saves, []
+        for i in range(0, len(jobs), SAVE_BATCH):
+            uid = "Save:" + uuid4().hex
+            worker = SaveWorker(jobs[i:i + SAVE_BATCH], self.save_index, self.configs, uid)
+            worker.signals.error.connect(self.deal_errors)
+            worker.signals.progress.connect(self.update_progress)
+            worker.signals.stop.connect(self.cleanup_progress)
+            self.term_signal.connect(worker.signals.terminate)
+            worker.signals.finish_save.connect(lambda saved: self.statusbar.showMessage("Saved " + saved, 3000))
+            self.update_progress(uid, 0)
+            self.background_pool.start(worker, SAVE_PRIORITY)
+
+    def find_duplicates(self):
+        self.statusbar.showMessage("Looking for duplicates in the save directory...")
+        worker = DedupeWorker(self.save_index, self.configs["save_dir"])
+        worker.signals.finish_dedupe.connect(self.find_duplicates_finished)
+        self.term_signal.connect(worker.signals.terminate)
+        self.background_pool.start(worker, SAVE_PRIORITY)
+
+    def find_duplicates_finished(self, identical, near):
+        self.statusbar.clearMessage()
+        if not identical and not near:
+            return QMessageBox.information(self, "Info", "No duplicates found.")
+        box = QMessageBox(QMessageBox.Icon.Information, "Duplicates",
+                          f"Found {len(identical)} group(s) of identical files and {len(near)} group(s) of "
+                          f"nearly identical images.\nSee the details for the file names.", parent=self)
+        box.setDetailedText("\n\n".join(["Identical:\n" + "\n".join(x) for x in identical] +
+                                         ["Nearly identical:\n" + "\n".join(x) for x in near]))
+        box.exec()
+
+    def export_trace(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Export Trace", p_join(PATH, "trace.json"), "Trace (*.json)")
+        if path:
+            count = export_trace(path)
+            QMessageBox.information(self, "Info", f"Exported {count} span(s).\n"
+                                    "Open the file in chrome://tracing or ui.perfetto.dev.")
+
     def show_detail(self):
         if self.current_image is None:
             return QMessageBox.warning(self, 'Warning', 'No images present now.')
-        self.detail_dialog.exec(self.previous_images[self.previous_image_index][1])
+        self.detail_dialog.exec(self.current_entry()[1])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,73 @@
+from requests import Session
+from requests.adapters import HTTPAdapter
+from socket import SHUT_RDWR
+from threading import BoundedSemaphore, Lock
+
+
+MAX_CONNECTIONS = 8  # For all the windows together, segments and URL queries included
+
+session = Session()  # Shared, so that the connections to the image and API hosts are reused
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=MAX_CONNECTIONS))
+session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=MAX_CONNECTIONS))
+_slots = BoundedSemaphore(MAX_CONNECTIONS)
+_in_flight = 0  # Slots taken, a request blocked in connecting holds one too
+_in_flight_lock = Lock()
+
+
+def count_slot(change):
+    global _in_flight
+    with _in_flight_lock:
+        _in_flight += change
+
+
+def in_flight():  # Requests still holding a connection, checked at shutdown
+    return _in_flight
+
+
+def abort_response(resp):  # Shut the socket down so that a thread blocked on reading it returns at once
+    sock = getattr(getattr(resp.raw, '_connection', None), 'sock', None)
+    try:
+        if sock is not None:
+            sock.shutdown(SHUT_RDWR)
+    except OSError:
+        pass
+    resp.close()
+
+
+class Connections:  # The responses of one worker, each holding a connection slot until it is closed
+    def __init__(self, stopped=lambda: False):
+        self.stopped = stopped
+        self.responses = []
+        self.lock = Lock()
+
+    def open(self, method, url, **kwargs):  # Returns None if stopped while waiting for a free slot
+        while not _slots.acquire(timeout=0.1):
+            if self.stopped():
+                return None
+        count_slot(1)
+        try:
+            resp = session.request(method, url, **kwargs)
+        except BaseException:
+            count_slot(-1)
+            _slots.release()
+            raise
+        with self.lock:
+            self.responses.append(resp)
+        if self.stopped():
+            abort_response(resp)
+        return resp
+
+    def close(self, resp):  # Once per response, closing it again does nothing
+        with self.lock:
+            if resp not in self.responses:
+                return
+            self.responses.remove(resp)
+        resp.close()
+        count_slot(-1)
+        _slots.release()
+
+    def abort(self):  # Called from another thread, the owner still closes the responses
+        with self.lock:
+            responses = self.responses.copy()
+        for resp in responses:
+            abort_response(resp)
@@ -1,3 +1,6 @@
+from PyQt6.QtCore import QObject, pyqtSignal
+
+
 class Tag:
     def __init__(self):
         self.tag = []
@@ -7,3 +10,77 @@ class Tag:
 
     def __str__(self):
         return '|'.join(self.tag)
+
+
+class AppState(QObject):  # Shared state of the viewer, the views subscribe to the signals instead of polling it
+    progress_changed = pyqtSignal(str, float)
+    progress_removed = pyqtSignal(str)
+    images_changed = pyqtSignal()
+    image_data_changed = pyqtSignal()
+    getting_url_changed = pyqtSignal(bool)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.images = []  # A List for storing (QPixmap, data, encoded bytes)
+        self.image_data = []  # A List for storing picture download URL
+        self.progresses_getimage = {}
+        self.progresses_saveimage = {}
+        self._getting_url = False  # A flag for checking whether the GET URL THREAD is running
+
+    @property
+    def getting_url(self):
+        return self._getting_url
+
+    @getting_url.setter
+    def getting_url(self, value):
+        if value != self._getting_url:
+            self._getting_url = value
+            self.getting_url_changed.emit(value)
+
+    def busy(self):
+        return bool(self.progresses_getimage or self.progresses_saveimage or self.getting_url)
+
+    def set_progress(self, uid, progress):
+        if uid[:4] == "Save":
+            self.progresses_saveimage[uid] = progress
+        else:
+            self.progresses_getimage[uid] = progress
+        self.progress_changed.emit(uid, progress)
+
+    def remove_progress(self, uid):
+        if uid in self.progresses_getimage.keys() or uid in self.progresses_saveimage.keys():
+            self.progresses_getimage.pop(uid, None)
+            self.progresses_saveimage.pop(uid, None)
+            self.progress_removed.emit(uid)
+
+    def add_images(self, entries, front=False):
+        if front:
+            self.images[:0] = entries
+        else:
+            self.images.extend(entries)
+        self.images_changed.emit()
+
+    def pop_image(self):
+        entry = self.images.pop(0)
+        self.images_changed.emit()
+        return entry
+
+    def clear_images(self):
+        self.images.clear()
+        self.images_changed.emit()
+
+    def add_image_data(self, records, front=False):
+        if front:
+            self.image_data[:0] = records
+        else:
+            self.image_data.extend(records)
+        self.image_data_changed.emit()
+
+    def pop_image_data(self):
+        record = self.image_data.pop(0)
+        self.image_data_changed.emit()
+        return record
+
+    def clear_image_data(self):
+        self.image_data.clear()
+        self.image_data_changed.emit()
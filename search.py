@@ -0,0 +1,131 @@
+import gzip
+from bisect import bisect_left
+from heapq import nlargest
+from json import loads as j_loads, dumps as j_dumps, JSONDecodeError
+from os.path import exists, join as p_join
+from sys import intern
+
+
+FIELDS = ["pid", "p", "title", "uid", "author", "tags", "url", "ext", "ai_type"]
+MIN_PREFIX = 2  # Shorter terms only match exactly, a single letter would expand to nearly every tag
+
+
+def parse_query(text):  # "a|b, c" -> [["t:a", "t:b"], ["t:c"]], groups are ANDed like the tag setting
+    groups = []
+    for group in text.split(","):
+        terms = []
+        for term in group.split("|"):
+            term = term.strip().lower()
+            if term.startswith("uid:"):
+                term = "u:" + term[4:].strip()
+            elif term.startswith("author:"):
+                term = "a:" + term[7:].strip()
+            else:
+                term = "t:" + term
+            if len(term) > 2:
+                terms.append(term)
+        if terms:
+            groups.append(terms)
+    return groups
+
+
+class TagIndex:  # Inverted index from tag, author and uid to every artwork fetched, for searching them
+    def __init__(self, path):
+        self.path = p_join(path, "tag_index.jsonl.gz")  # Appended one gzip member per save
+        self.records = []  # Tuples in the order of FIELDS, the position is the record id
+        self.keys = {}  # "pid_p" -> record id
+        self.postings = {}  # term -> set of record ids
+        self.terms = []  # Sorted, for prefix lookups while typing
+        self.saved = 0  # Records already in the file
+        self.loaded = False
+
+    def read(self, stopped=lambda: False):  # Called on a fresh index in a worker thread, see merge
+        if not exists(self.path):
+            return
+        try:
+            with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+                columns = None
+                for line in f:
+                    if stopped():
+                        return
+                    row = j_loads(line)
+                    if type(row) is dict:  # Header of the file
+                        columns = [row["fields"].index(k) for k in FIELDS]
+                    elif columns is not None:
+                        self.insert({k: row[i] for k, i in zip(FIELDS, columns)})
+        except (OSError, EOFError, JSONDecodeError, UnicodeDecodeError, KeyError, TypeError, ValueError,
+                IndexError):
+            pass  # Keep what was read before a save cut short
+        self.terms = sorted(self.postings)
+        self.saved = len(self.records)
+
+    def merge(self, other):  # Take over the index read from the disk, then add what was fetched meanwhile
+        fetched = [self.record(i) for i in range(len(self.records))]
+        self.records, self.keys, self.postings, self.terms = other.records, other.keys, other.postings, other.terms
+        self.saved = other.saved
+        self.loaded = True
+        self.add(fetched)
+
+    def save(self):  # Only the records added since the last save are appended
+        if not self.loaded or self.saved >= len(self.records):  # Before merge the file may still be being read
+            return
+        new = not exists(self.path)
+        with gzip.open(self.path, 'at', encoding='utf-8') as f:
+            if new:
+                f.write(j_dumps({"fields": FIELDS}) + "\n")
+            for row in self.records[self.saved:]:
+                f.write(j_dumps(row, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self.saved = len(self.records)
+
+    @staticmethod
+    def index_terms(record):
+        return {"t:" + x.lower() for x in record["tags"]} | {"a:" + record["author"].lower(), f'u:{record["uid"]}'}
+
+    def insert(self, record):  # Returns the new terms, None if already indexed
+        key = f'{record["pid"]}_{record["p"]}'
+        if key in self.keys:
+            return None
+        index = len(self.records)
+        self.keys[key] = index
+        record = {**record, "tags": [intern(x) for x in record["tags"]]}
+        self.records.append(tuple(record[k] for k in FIELDS))
+        new = []
+        for term in self.index_terms(record):
+            if term not in self.postings:
+                self.postings[term] = set()
+                new.append(term)
+            self.postings[term].add(index)
+        return new
+
+    def add(self, records):  # A metadata batch from the API, the offline gallery records are skipped
+        new = []
+        for record in records:
+            if not record.get("path"):
+                new.extend(self.insert(record) or [])
+        if new:
+            self.terms = sorted(self.terms + new)
+
+    def record(self, index):
+        return dict(zip(FIELDS, self.records[index]))
+
+    def lookup(self, term):  # Record ids of the terms starting with term, uids match exactly
+        if term.startswith("u:") or len(term) - 2 < MIN_PREFIX:
+            return self.postings.get(term, set())
+        result = set()
+        i = bisect_left(self.terms, term)
+        while i < len(self.terms) and self.terms[i].startswith(term):
+            result |= self.postings[self.terms[i]]
+            i += 1
+        return result
+
+    def search(self, text, limit=200):  # Returns (number of matches, newest matching records up to limit)
+        groups = parse_query(text)
+        if not groups:
+            return 0, []
+        matches = sorted([set().union(*[self.lookup(term) for term in group]) for group in groups], key=len)
+        result = matches[0]
+        for ids in matches[1:]:
+            if not result:
+                break
+            result = result & ids
+        return len(result), [self.record(i) for i in nlargest(limit, result)]
@@ -1,111 +1,656 @@
 from PyQt6.QtCore import QRunnable, pyqtSignal, QObject
 from PyQt6.QtGui import QPixmap, QImage
-from io import BytesIO
-from requests import get, post, ConnectionError, ConnectTimeout, exceptions
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor, wait
+from itertools import zip_longest
+from os import scandir, replace
+from os.path import exists, getsize, join as p_join
+from re import compile as re_compile
+from requests import ConnectionError, ConnectTimeout, exceptions
+from threading import Lock, Event
+from time import sleep, perf_counter
 from uuid import uuid4
 
+from bandwidth import throttle
+from configs import load_queue
+from filters import filter_records, include_list
+from gallery import IMAGE_EXTS, save_filename, save_sidecar, part_source, save_part, discard_part, \
+    remove_stale_parts
+from imaging import decode, decode_image, hash_image, near_duplicates, transcode_images
+from network import Connections
+from search import TagIndex
+from tracing import record, span
+
+
+SEGMENT_THRESHOLD = 4 * 1024 * 1024  # Files larger than this are fetched over several connections
+SEGMENT_NUM = 4
+PREVIEW_MIN_SIZE = 256 * 1024  # Smaller files arrive too soon for a preview to be worth decoding
+PREVIEW_MIN_RATIO = 0.2  # Too little of the image before this to show anything useful
+PREVIEW_INTERVAL = 0.5  # Seconds between two previews of the same download
+MAX_EMPTY_BATCHES = 5  # Give up on a shard after this many batches in a row are entirely filtered out
+API_MAX_UIDS = 20  # Limits of one API query
+API_MAX_OR = 20
+API_MAX_AND = 3
+MAX_SHARDS = 64
+MAX_SHARD_QUERIES = 4  # Shards queried at the same time
+CONTENT_RANGE = re_compile(r"bytes (\d+)-\d+/(\d+)")
+
+preview_decoder = ThreadPoolExecutor(max_workers=2)  # Previews are decoded here, off the threads reading sockets
+
+
+class RangeNotSupported(Exception):
+    ...
+
 
 class Signals(QObject):
     progress = pyqtSignal(str, float)
-    finish_download = pyqtSignal(QPixmap, str, dict)
+    finish_download = pyqtSignal(QPixmap, str, dict, object)
     finish_geturl = pyqtSignal()
     return_urls = pyqtSignal(list)
     terminate = pyqtSignal(str)
     stop = pyqtSignal(str)
-    update_url_count = pyqtSignal(int)
+    update_url_count = pyqtSignal(int, int)
     error = pyqtSignal(str, str)
+    restore_queue = pyqtSignal(list, list)
+    finish_thumbnail = pyqtSignal(str, QImage)
+    finish_scan = pyqtSignal(bool)
+    finish_dedupe = pyqtSignal(list, list)
+    finish_save = pyqtSignal(str)
+    finish_decode = pyqtSignal(object, QImage)
+    finish_index = pyqtSignal(object)
+    preview = pyqtSignal(str, QImage)
+
+
+def chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)] or [[]]
+
+
+def make_shards(configs):  # Split the author and tag filters into queries within the API limits
+    # Returns the queries and the tag groups left to be checked locally. The results of the queries are unioned, so
+    # only the uids and the alternatives of an OR group can be split. Tag groups beyond what the API takes, or which
+    # would split into too many queries, are checked on the results instead.
+    shards = [{"uid": x, "tag": []} for x in chunks([x[0] for x in configs["authors"]], API_MAX_UIDS)]
+    local = []
+    for group in [x for x in configs["tag"] if x]:
+        group_chunks = chunks(group, API_MAX_OR)
+        if len(shards[0]["tag"]) >= API_MAX_AND or len(shards) * len(group_chunks) > MAX_SHARDS:
+            local.append(group)
+            continue
+        shards = [{"uid": shard["uid"], "tag": shard["tag"] + [x]} for shard in shards for x in group_chunks]
+    return shards, local
+
+
+def interleave(batches):  # Round-robin over the batches of the shards, so that no shard crowds the others out
+    return [x for row in zip_longest(*batches) for x in row if x is not None]
 
 
 class GetPictureURLsWorker(QRunnable):
-    def __init__(self, configs, curr_url_count):
+    def __init__(self, configs, curr_url_count, seen=None, target=None):
         super().__init__()
         self.signals = Signals()
         self.configs = configs
         self.curr_url_count = curr_url_count
+        self.target = configs.get('cache_num') if target is None else target  # URLs queued before it stops
+        self.seen = seen if seen is not None else set()
         self.stop = False
+        self.connections = Connections(lambda: self.stop)
         self.signals.update_url_count.connect(self.update_curr_url_count)
+        self.signals.terminate.connect(self.terminate)
         self.uuid = uuid4().hex
 
-    def update_curr_url_count(self, curr_url_count):
+    def update_curr_url_count(self, curr_url_count, target):
         self.curr_url_count = curr_url_count
+        self.target = target
 
-    def run(self):
-        while self.curr_url_count <= self.configs.get('cache_num'):
+    def terminate(self, type_):  # The queries in flight are aborted, one still connecting times out on its own
+        if type_ in ["fetch", "all"] and not self.stop:
+            self.stop = True
+            self.connections.abort()
+            self.signals.stop.emit(self.uuid)
+
+    def query(self, shard):
+        with span("url request", self.uuid, uids=len(shard["uid"]), tags=len(shard["tag"])):
+            resp = self.connections.open("POST", "https://api.lolicon.app/setu/v2",
+                                         json={
+                                             'r18': self.configs.get('r18'),
+                                             'num': 20,
+                                             'tag': shard["tag"],
+                                             'uid': shard["uid"],
+                                             'excludeAI': bool(self.configs['ex_ai']),
+                                             'size': ['original', 'regular', 'small', 'thumb', 'mini']
+                                         }, stream=True, timeout=5)
+            if resp is None:  # Stopped while waiting for a connection
+                return None
             try:
-                info = post("https://api.lolicon.app/setu/v2",
-                            json={
-                                'r18': self.configs.get('r18'),
-                                'num': 20,
-                                'tag': self.configs['tag'],
-                                'uid': [x[0] for x in self.configs["authors"]],
-                                'size': ['original', 'regular', 'small', 'thumb', 'mini']
-                            }, timeout=5).json().get("data")
-            except (ConnectionError, exceptions.ReadTimeout, exceptions.SSLError, exceptions.ChunkedEncodingError):
-                return self.signals.error.emit('get_url_failed', self.uuid)
-            if not info:
-                return self.signals.error.emit("no_pic", self.uuid)
-            data = [{'pid': dic['pid'], 'title': dic['title'], 'uid': dic['uid'], 'author': dic['author'],
-                     "tags": dic['tags'], "url": dic['urls'], "ext": dic['ext'], "ai_type": dic['aiType'],
-                     "p": dic['p']} for dic in info]
-            self.signals.return_urls.emit(data)
-            sleep(0.1)
+                resp.raise_for_status()  # e.g. 429 when querying too fast, with an HTML page instead of JSON
+                return resp.json().get("data")
+            finally:
+                self.connections.close(resp)
+
+    def run(self):
+        shards, local = make_shards(self.configs)
+        active = list(range(len(shards)))  # Shards not exhausted yet
+        empty_batches = [0] * len(shards)
+        executor = ThreadPoolExecutor(max_workers=MAX_SHARD_QUERIES)
+        try:
+            while self.curr_url_count <= self.target and not self.stop:
+                batch = active[:MAX_SHARD_QUERIES]  # Queried together, so a round takes one round-trip
+                active = active[MAX_SHARD_QUERIES:] + batch
+                futures = [(i, executor.submit(self.query, shards[i])) for i in batch]
+                results = []
+                failed = 0
+                for i, future in futures:
+                    while not future.done() and not self.stop:  # Leave the aborted queries behind when stopped
+                        wait([future], timeout=0.1)
+                    if self.stop:
+                        return
+                    try:
+                        info = future.result()
+                    except (ConnectionError, exceptions.ReadTimeout, exceptions.SSLError,
+                            exceptions.ChunkedEncodingError, exceptions.HTTPError, ValueError):
+                        failed += 1
+                        continue
+                    if not info:  # Nothing at all matches the shard
+                        active.remove(i)
+                        continue
+                    data = [{'pid': dic['pid'], 'title': dic['title'], 'uid': dic['uid'], 'author': dic['author'],
+                             "tags": dic['tags'], "url": dic['urls'], "ext": dic['ext'], "ai_type": dic['aiType'],
+                             "p": dic['p']} for dic in info]
+                    data = [x for x in data if all(include_list(group, x["tags"]) for group in local)]
+                    data = filter_records(data, self.configs, self.seen)
+                    if not data:
+                        empty_batches[i] += 1
+                        if empty_batches[i] >= MAX_EMPTY_BATCHES:  # Only duplicates or excluded ones are left
+                            active.remove(i)
+                        continue
+                    empty_batches[i] = 0
+                    results.append(data)
+                if self.stop:
+                    return
+                if failed == len(batch):
+                    return self.signals.error.emit('get_url_failed', self.uuid)
+                if not active:
+                    return self.signals.error.emit("no_pic", self.uuid)
+                if results:
+                    self.signals.return_urls.emit(interleave(results))
+                sleep(0.1)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
         self.signals.finish_geturl.emit()
 
 
+class RestoreQueueWorker(QRunnable):
+    def __init__(self, path, configs, size=None, profile=None):
+        super().__init__()
+        self.signals = Signals()
+        self.path = path
+        self.configs = configs
+        self.size = size
+        self.profile = profile
+
+    def run(self):
+        image_data, prefetched = load_queue(self.path, self.configs, self.profile)
+        images = []
+        for data, raw in prefetched:
+            pixmap = QPixmap.fromImage(decode(raw, self.size))
+            if not pixmap.isNull():
+                images.append((pixmap, data, raw))
+        self.signals.restore_queue.emit(image_data, images)
+
+
+class ThumbnailWorker(QRunnable):
+    def __init__(self, key, url, size, path=None):
+        super().__init__()
+        self.signals = Signals()
+        self.key = key
+        self.url = url
+        self.size = size
+        self.path = path  # Read from the disk instead, for the offline gallery
+        self.connections = Connections()
+
+    def run(self):
+        try:
+            if self.path:
+                with open(self.path, 'rb') as f:
+                    raw = f.read()
+            else:
+                resp = self.connections.open("GET", self.url, timeout=5)
+                try:
+                    raw = resp.content if resp.status_code == 200 else b''
+                finally:
+                    self.connections.close(resp)
+        except (ConnectionError, exceptions.SSLError, exceptions.ChunkedEncodingError, exceptions.ReadTimeout,
+                OSError):
+            return self.signals.finish_thumbnail.emit(self.key, QImage())
+        self.signals.finish_thumbnail.emit(self.key, decode_image(raw, self.size) if raw else QImage())
+
+
+class TagIndexWorker(QRunnable):  # Read the search index from the disk without blocking the startup
+    def __init__(self, path):
+        super().__init__()
+        self.signals = Signals()
+        self.path = path
+        self.stop = False
+        self.signals.terminate.connect(self.terminate)
+
+    def terminate(self, type_):
+        if type_ == "all":
+            self.stop = True
+
+    def run(self):
+        index = TagIndex(self.path)
+        index.read(lambda: self.stop)
+        if not self.stop:  # A partly read index is never merged, nor saved
+            self.signals.finish_index.emit(index)
+
+
+class DecodeWorker(QRunnable):  # Decode a history entry before the user goes back to it
+    def __init__(self, data, raw, size=None):
+        super().__init__()
+        self.signals = Signals()
+        self.data = data
+        self.raw = raw
+        self.size = size
+
+    def run(self):
+        self.signals.finish_decode.emit(self.data, decode(self.raw, self.size))
+
+
+class GalleryScanWorker(QRunnable):
+    def __init__(self, index, directory):
+        super().__init__()
+        self.signals = Signals()
+        self.index = index
+        self.directory = directory
+        self.stop = False
+        self.signals.terminate.connect(self.terminate)
+
+    def terminate(self, type_):
+        if type_ == "all":
+            self.stop = True
+
+    def run(self):
+        try:
+            changed = self.index.scan(self.directory, lambda: self.stop)
+            if changed:
+                self.index.save()
+        except OSError:
+            changed = False
+        self.signals.finish_scan.emit(changed)
+
+
+class PartCleanupWorker(QRunnable):
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+
+    def run(self):
+        remove_stale_parts(self.directory)
+
+
+class DedupeWorker(QRunnable):  # Find byte-identical and perceptually near-identical files in save_dir
+    def __init__(self, index, directory):
+        super().__init__()
+        self.signals = Signals()
+        self.index = index
+        self.directory = directory
+        self.stop = False
+        self.signals.terminate.connect(self.terminate)
+
+    def terminate(self, type_):
+        if type_ == "all":
+            self.stop = True
+
+    def run(self):
+        files = {}
+        try:
+            with scandir(self.directory) as it:
+                for entry in it:
+                    if self.stop:  # The hashes so far are still kept for the next time
+                        break
+                    if not entry.is_file() or entry.name.rsplit(".", 1)[-1].lower() not in IMAGE_EXTS:
+                        continue
+                    stat = entry.stat()
+                    info = self.index.file_info(self.directory, entry.name)
+                    if info is not None and info[0] == stat.st_mtime_ns and info[1] == stat.st_size and \
+                            info[3] is not None:  # Hashed before and not modified since
+                        files[entry.name] = info
+                        continue
+                    with open(entry.path, 'rb') as f:
+                        raw = f.read()
+                    digest, difference_hash = hash_image(raw)
+                    files[entry.name] = [stat.st_mtime_ns, stat.st_size, digest, difference_hash]
+        except OSError:
+            pass
+        self.index.update_files(self.directory, files)
+        self.index.save()
+        if self.stop:
+            return
+        by_hash = {}
+        for name, info in files.items():
+            by_hash.setdefault(info[2], []).append(name)
+        identical = [sorted(x) for x in by_hash.values() if len(x) > 1]
+        near = [x for x in near_duplicates({k: v[3] for k, v in files.items() if v[3] is not None})
+                if len({files[name][2] for name in x}) > 1]
+        self.signals.finish_dedupe.emit(identical, near)
+
+
+class SaveWorker(QRunnable):  # Transcode, hash and write a batch of saved images off the GUI thread
+    def __init__(self, jobs, index, configs, uid):
+        super().__init__()
+        self.signals = Signals()
+        self.jobs = jobs  # [(encoded bytes, data)]
+        self.index = index
+        self.directory = configs["save_dir"]
+        self.options = (configs["save_format"], configs["save_image_quality"], configs["save_max_size"])
+        self.sidecar = configs["save_sidecar"]
+        self.uuid = uid  # The batch counts as saving work until stop is emitted
+        self.stop = False
+        self.signals.terminate.connect(self.terminate)
+
+    def terminate(self, type_):  # The images not written yet are given up
+        if type_ == "all":
+            self.stop = True
+
+    def run(self):
+        try:
+            self.save()
+        finally:
+            self.signals.stop.emit(self.uuid)
+
+    def save(self):
+        if self.stop:
+            return
+        try:
+            results = transcode_images([(raw, data["ext"], *self.options) for raw, data in self.jobs])
+        except OSError:
+            return self.signals.error.emit('save_pic_failed', '')
+        for i, ((_, data), (raw, ext, digest, difference_hash)) in enumerate(zip(self.jobs, results)):
+            if self.stop:
+                return
+            path = p_join(self.directory, save_filename({**data, "ext": ext}))
+            try:
+                saved = self.index.find_hash(digest, self.directory)
+                if saved is None:  # Not saved under another name yet
+                    with open(path + ".tmp", 'wb') as f:  # Never leave a truncated image behind
+                        f.write(raw)
+                    replace(path + ".tmp", path)
+                    saved = path
+                self.index.add(data, saved, digest, difference_hash)
+                if self.sidecar:
+                    save_sidecar(saved, data)
+            except OSError:
+                self.signals.error.emit('save_pic_failed', '')
+                continue
+            self.signals.progress.emit(self.uuid, (i + 1) / len(self.jobs) * 100)
+            self.signals.finish_save.emit(saved)
+
+
 class DownloaderWorker(QRunnable):
-    def __init__(self, data, uid, configs, type_="fetch"):
+    def __init__(self, data, uid, configs, type_="fetch", size=None, raw=None, traffic=None):
         super().__init__()
         self.signals = Signals()
         self.data = data
         self.type = type_
+        # Which bandwidth limit applies, a prefetch is promoted to view once the user is waiting for it
+        self.traffic = traffic or ("save" if type_ == "download" else "view")
         self.configs = configs
+        self.size = size  # Display size to decode at, None for full resolution
+        self.raw = raw  # Already downloaded by another window
+        self.elapsed = None  # Seconds spent on the network, for estimating the next downloads
+        self.created = perf_counter()
+        self.previewed = 0.0
+        self.previewing = False  # One preview decode at a time, the requests meanwhile are dropped
         self.stop = False
         self.uuid = uid
+        self.connections = Connections(lambda: self.stop)  # Aborted on terminate
+        # Unfinished saves are kept here and resumed next time
+        self.part_path = p_join(configs["save_dir"], save_filename(data)) + ".part" if type_ == "download" else None
+        self.part_source = None  # Where the bytes come from, checked before resuming from them
         self.signals.terminate.connect(self.terminate)
         self.signals.progress.emit(self.uuid, 0)
 
+    @staticmethod
+    def source(data, configs, type_="fetch"):  # What the worker reads, used to share downloads between windows
+        if data.get("path"):
+            return data["path"]
+        return data['url'][configs["view_quality"] if type_ == 'fetch' else configs["save_quality"]]
+
     def terminate(self, type_):
         if type_ == self.type or type_ == "all":
             self.stop = True
+            self.connections.abort()
+
+    def open(self, url, headers=None):  # Returns None if stopped before a connection was free
+        with span("connect", self.uuid, range=(headers or {}).get('Range', '')):
+            return self.connections.open("GET", url, headers=headers, stream=True, timeout=5)
+
+    def save_partial(self, buffer):  # Flush the received prefix of a stopped save
+        if self.part_path is not None and self.part_source is not None and len(buffer):
+            try:
+                save_part(self.part_path, buffer, self.part_source)
+            except OSError:
+                pass
 
     def run(self):
+        record("pool wait", self.uuid, self.created)
         try:
             if self.stop:
                 return self.signals.stop.emit(self.uuid)
-            if self.type == 'fetch':
-                url = self.data['url'][self.configs["view_quality"]]
+            if self.raw is not None:
+                image_raw = self.raw
+            elif self.data.get("path"):  # From the offline gallery
+                with open(self.data["path"], 'rb') as f:
+                    image_raw = f.read()
             else:
-                url = self.data['url'][self.configs["save_quality"]]
-            resp = get(url, stream=True, timeout=5)
-            total = int(resp.headers.get('content-length', -1))
-            current = 0
-            image = BytesIO()
-            if resp.status_code == 404:
+                start = perf_counter()
+                image_raw = self.fetch()
+                if image_raw is None or self.stop:
+                    return self.signals.stop.emit(self.uuid)
+                self.elapsed = perf_counter() - start
+                if self.part_path is not None:
+                    discard_part(self.part_path)
+        except (ConnectionError, exceptions.SSLError, exceptions.ChunkedEncodingError, exceptions.ReadTimeout,
+                OSError):
+            if self.stop:  # The connection was closed by terminate
                 return self.signals.stop.emit(self.uuid)
-            for chunk in resp.iter_content(chunk_size=10240):
-                if chunk:
-                    if self.stop:
-                        return self.signals.stop.emit(self.uuid)
-                    current += len(chunk)
-                    image.write(chunk)
-                    if total > 0:
-                        self.signals.progress.emit(self.uuid, current / total * 100)
-                sleep(0.01)
-        except (ConnectionError, exceptions.SSLError, exceptions.ChunkedEncodingError, exceptions.ReadTimeout):
             if self.type == 'fetch':
                 self.signals.error.emit('get_pic_failed', self.uuid)
             elif self.type == 'download':
                 self.signals.error.emit('save_pic_failed', self.uuid)
         else:
-            image_raw = image.getvalue()
             if image_raw:
-                if self.type == 'download':
+                if self.type == 'download':  # Saved as-is, no need to decode
                     self.data["download"] = True
-                pixmap = QPixmap.fromImage(QImage.fromData(image.getvalue()))
-                return self.signals.finish_download.emit(pixmap, self.uuid, self.data)
+                    return self.signals.finish_download.emit(QPixmap(), self.uuid, self.data, image_raw)
+                with span("decode", self.uuid, size=len(image_raw)):
+                    pixmap = QPixmap.fromImage(decode(image_raw, self.size))
+                if not pixmap.isNull():
+                    return self.signals.finish_download.emit(pixmap, self.uuid, self.data, image_raw)
             if self.type == "fetch":
                 self.signals.error.emit('get_pic_failed', self.uuid)
             elif self.type == "download":
                 self.signals.error.emit('save_pic_failed', self.uuid)
             print(self.data['url'])
+
+    def fetch(self):  # Returns the bytes in a bytearray, None if stopped or not found
+        url = self.source(self.data, self.configs, self.type)
+        prefix = 0
+        source = part_source(self.part_path) if self.part_path is not None and exists(self.part_path) else None
+        if source is not None and source.get("url") == url and 0 < getsize(self.part_path) < source.get("length", 0):
+            prefix = getsize(self.part_path)  # Resume an unfinished save of the same file
+            headers = {'Range': f'bytes={prefix}-'}
+            if source.get("validator"):
+                headers['If-Range'] = source["validator"]  # The whole file comes instead if it changed meanwhile
+            resp = self.open(url, headers)
+            if resp is not None and not self.resumes(resp, prefix, source["length"]):
+                prefix = 0
+                discard_part(self.part_path)
+                if resp.status_code != 200:
+                    self.connections.close(resp)
+                    resp = self.open(url)
+            elif resp is not None:
+                self.part_source = source
+        else:
+            if self.part_path is not None:  # Of another quality, or of unknown origin
+                discard_part(self.part_path)
+            resp = self.open(url)
+        if resp is None:
+            return None
+        try:
+            if resp.status_code == 404:
+                return None
+            length = int(resp.headers.get('content-length', -1))
+            total = length + prefix if length > 0 else -1
+            if prefix == 0 and total > 0:
+                etag = resp.headers.get('ETag', '')
+                # Weak ETags may not be used in If-Range
+                validator = etag if etag and not etag.startswith('W/') else resp.headers.get('Last-Modified')
+                self.part_source = {"url": url, "length": total, "validator": validator}
+            if prefix == 0 and total > SEGMENT_THRESHOLD and resp.headers.get('accept-ranges') == 'bytes':
+                self.connections.close(resp)  # Its slot goes to the segments
+                try:
+                    return self.fetch_segmented(url, total)
+                except RangeNotSupported:
+                    resp = self.open(url)
+                    if resp is None:
+                        return None
+            return self.read(resp, prefix, total)
+        finally:
+            self.connections.close(resp)
+
+    @staticmethod
+    def resumes(resp, prefix, total):  # The response continues the partial file exactly
+        match = CONTENT_RANGE.match(resp.headers.get('content-range', ''))
+        return resp.status_code == 206 and match is not None and int(match.group(1)) == prefix and \
+            int(match.group(2)) == total
+
+    def read(self, resp, prefix, total):
+        # Filled in place when the length is known, the same bytearray then goes on to decode, cache and save
+        buffer = bytearray(total if total > 0 else prefix)
+        view = memoryview(buffer)
+        if prefix:
+            with open(self.part_path, 'rb') as f:
+                f.readinto(view[:prefix])
+        current = prefix
+        start = perf_counter()
+        try:
+            for chunk in resp.iter_content(chunk_size=10240):
+                if chunk:
+                    if self.stop:
+                        break
+                    if total < 0:  # Unknown length, grow instead
+                        view.release()
+                        buffer += chunk
+                        view = memoryview(buffer)
+                    elif current + len(chunk) > total:
+                        raise exceptions.ChunkedEncodingError
+                    else:
+                        view[current:current + len(chunk)] = chunk
+                    current += len(chunk)
+                    if total > 0:
+                        self.signals.progress.emit(self.uuid, current / total * 100)
+                        self.preview(view, current, total)
+                    throttle(self.traffic, len(chunk), lambda: self.stop)
+        except (ConnectionError, exceptions.ChunkedEncodingError, exceptions.ReadTimeout):
+            if not self.stop:
+                raise
+        finally:
+            record("transfer", self.uuid, start, size=current)
+        if self.stop:
+            self.save_partial(view[:current])
+            return None
+        if 0 < total != current:
+            raise exceptions.ChunkedEncodingError
+        view.release()
+        return buffer
+
+    def preview(self, view, received, total):  # Decode what has arrived, a progressive JPEG shows a rough image
+        now = perf_counter()
+        if self.previewing or self.type != "fetch" or self.traffic != "view" or total < PREVIEW_MIN_SIZE or \
+                received == total or now - self.previewed < PREVIEW_INTERVAL or received < total * PREVIEW_MIN_RATIO:
+            return
+        self.previewing = True
+        preview_decoder.submit(self.decode_preview, view[:received])  # The prefix is not written any more
+
+    def decode_preview(self, prefix):
+        try:
+            with span("preview", self.uuid, size=len(prefix)):
+                image = decode_image(prefix, self.size)
+            if not image.isNull() and not self.stop:
+                self.signals.preview.emit(self.uuid, image)
+        finally:
+            prefix.release()
+            self.previewed = perf_counter()
+            self.previewing = False
+
+    def fetch_segmented(self, url, total):  # Fetch byte ranges in parallel straight into one preallocated buffer
+        buffer = bytearray(total)
+        view = memoryview(buffer)
+        size = -(-total // SEGMENT_NUM)
+        ranges = [(start, min(start + size, total)) for start in range(0, total, size)]
+        received = [0] * len(ranges)
+        lock = Lock()
+        failed = Event()
+
+        def fetch(index):
+            try:
+                fetch_range(index)
+            except Exception:
+                failed.set()
+                raise
+
+        def fetch_range(index):
+            start, end = ranges[index]
+            resp = self.open(url, {'Range': f'bytes={start}-{end - 1}'})
+            if resp is None:
+                return
+            try:
+                read_range(index, resp)
+            finally:
+                self.connections.close(resp)
+
+        def read_range(index, resp):
+            start, end = ranges[index]
+            if resp.status_code != 206:
+                raise RangeNotSupported
+            position = start
+            transfer = perf_counter()
+            try:
+                for chunk in resp.iter_content(chunk_size=10240):
+                    if self.stop or failed.is_set():
+                        return
+                    if chunk:
+                        if position + len(chunk) > end:
+                            raise exceptions.ChunkedEncodingError
+                        view[position:position + len(chunk)] = chunk
+                        position += len(chunk)
+                        with lock:
+                            received[index] = position - start
+                            current = sum(received)
+                        self.signals.progress.emit(self.uuid, current / total * 100)
+                        if index == 0:  # Only the first segment grows a decodable prefix
+                            self.preview(view, position, total)
+                        throttle(self.traffic, len(chunk), lambda: self.stop or failed.is_set())
+            except (ConnectionError, exceptions.ChunkedEncodingError, exceptions.ReadTimeout):
+                if not self.stop:
+                    raise
+                return
+            finally:
+                record("transfer", self.uuid, transfer, segment=index, size=position - start)
+            if position != end:
+                raise exceptions.ChunkedEncodingError
+
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(fetch, index) for index in range(len(ranges))]
+            for future in futures:
+                future.result()
+        if self.stop:
+            prefix = 0  # Only the contiguous part from the start can be resumed
+            for (start, end), count in zip(ranges, received):
+                prefix = start + count
+                if prefix < end:
+                    break
+            self.save_partial(view[:prefix])
+            return None
+        view.release()
+        return buffer
@@ -0,0 +1,43 @@
+from collections import deque
+from contextlib import contextmanager
+from os import getpid
+from threading import Lock
+from time import perf_counter
+
+from configs import dump_atomic
+
+
+TRACE_EVENTS = 100000  # The oldest spans are dropped beyond this, so tracing can always stay on
+
+_events = deque(maxlen=TRACE_EVENTS)  # (name, uid, start, end, args), times from perf_counter()
+_lock = Lock()
+
+
+def record(name, uid, start, end=None, **args):
+    with _lock:
+        _events.append((name, uid, start, perf_counter() if end is None else end, args))
+
+
+@contextmanager
+def span(name, uid, **args):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        record(name, uid, start, **args)
+
+
+def export(path):  # Chrome trace-event JSON, one row per task uid
+    with _lock:
+        events = list(_events)
+    pid = getpid()
+    lanes = {}
+    trace = []
+    for name, uid, start, end, args in events:
+        if uid not in lanes:
+            lanes[uid] = len(lanes) + 1
+            trace.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": lanes[uid], "args": {"name": uid}})
+        trace.append({"name": name, "cat": uid.split(":")[0] if ":" in uid else "task", "ph": "X", "pid": pid,
+                      "tid": lanes[uid], "ts": start * 1e6, "dur": (end - start) * 1e6, "args": {"uid": uid, **args}})
+    dump_atomic(path, {"traceEvents": trace, "displayTimeUnit": "ms"})
+    return len(events)
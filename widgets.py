@@ -1,38 +1,167 @@
 import sys
 
-from PyQt6.QtCore import Qt, QSize, QTimer
-from PyQt6.QtGui import QPixmap, QShortcut, QKeySequence
+from PyQt6.QtCore import Qt, QSize, QTimer, QAbstractListModel, QModelIndex
+from PyQt6.QtGui import QPixmap, QShortcut, QKeySequence, QColor
 from PyQt6.QtWidgets import QLabel, QWidget, QVBoxLayout, QListWidget, QListWidgetItem, QPushButton, \
     QProgressBar, QHBoxLayout, QRadioButton, QDialog, QTabWidget, QGridLayout, QLineEdit, QSizePolicy, QFileDialog, \
-    QMessageBox, QButtonGroup, QSlider, QSpinBox, QTableWidget, QTableWidgetItem
+    QMessageBox, QButtonGroup, QSlider, QSpinBox, QTableWidget, QTableWidgetItem, QListView, QAbstractItemView
 from PyQt6.uic import loadUi
+from collections import OrderedDict
 from functools import partial
 from os.path import join as p_join
 
+from engine import DownloadEngine, THUMBNAIL_PRIORITY
+from filters import is_ai
+from bandwidth import TRAFFIC
+from imaging import decode_image, image_size
+from tracing import span
+from threads import ThumbnailWorker
+
+
+THUMBNAIL_SIZE = QSize(80, 80)
+
 
 class PixmapLabel(QLabel):
     def __init__(self, parent=None):
         super().__init__(parent)
         self.original_pixmap = None
+        self.source_pixmap = None  # The pixmap given by the caller, before any re-decoding
+        self.raw = None  # Encoded bytes of the image, for decoding at a higher resolution on demand
+        self.trace_uid = "display"  # Task the image came from, for the trace
         self.previous_width = self.width()
         self.previous_height = self.height()
 
+    def target_size(self):
+        return QSize(self.size().width() - 10, self.size().height() - 10)
+
     def paintEvent(self, event):
         if self.original_pixmap is not None and \
                     (self.previous_height != self.height() or self.previous_width != self.width()):
             self.previous_height = self.height()
             self.previous_width = self.width()
-            self.setPixmap(self.original_pixmap.scaled(QSize(self.size().width() - 10, self.size().height() - 10),
+            self.upgrade_pixmap()
+            self.scale_pixmap()
+        super().paintEvent(event)
+
+    def scale_pixmap(self):
+        with span("scale", self.trace_uid):
+            self.setPixmap(self.original_pixmap.scaled(self.target_size(),
                                                        Qt.AspectRatioMode.KeepAspectRatio,
                                                        Qt.TransformationMode.SmoothTransformation))
-        super().paintEvent(event)
 
-    def set_original_pixmap(self, original_pixmap: QPixmap | None):
+    def upgrade_pixmap(self):  # Re-decode from the encoded bytes if the label outgrew a reduced-size decode
+        if self.raw is None:
+            return
+        target = self.target_size()
+        if self.original_pixmap.width() >= target.width() or self.original_pixmap.height() >= target.height():
+            return
+        source = image_size(self.raw)
+        if source.isValid() and self.original_pixmap.width() < source.width():
+            with span("decode", self.trace_uid, upgrade=True):
+                self.original_pixmap = QPixmap.fromImage(decode_image(self.raw, target))
+
+    def set_original_pixmap(self, original_pixmap: QPixmap | None, raw=None, trace_uid=None):
+        if original_pixmap is not None and original_pixmap is self.source_pixmap and raw is self.raw:
+            return
+        self.source_pixmap = original_pixmap
         self.original_pixmap = original_pixmap
+        self.raw = raw
+        self.trace_uid = trace_uid or "display"
         if self.original_pixmap is not None:
-            self.setPixmap(original_pixmap.scaled(QSize(self.size().width() - 10, self.size().height() - 10),
-                                                  Qt.AspectRatioMode.KeepAspectRatio,
-                                                  Qt.TransformationMode.SmoothTransformation))
+            self.upgrade_pixmap()
+            self.scale_pixmap()
+
+
+class HistoryModel(QAbstractListModel):  # Metadata of every viewed image, thumbnails are loaded on demand
+    def __init__(self, parent=None, cache_size=300):
+        super().__init__(parent)
+        self.records = []
+        self.rows = {}  # Thumbnail key -> row
+        self.thumbnails = OrderedDict()  # LRU cache of thumbnail key -> QPixmap
+        self.cache_size = cache_size
+        self.pending = set()
+        self.thread_pool = DownloadEngine.instance().thread_pool  # Shared with the downloads of every window
+        self.placeholder = QPixmap(THUMBNAIL_SIZE)
+        self.placeholder.fill(QColor("lightgray"))
+
+    @staticmethod
+    def key(record):
+        return f'{record["pid"]}_{record["p"]}'
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.records)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):  # Only called by the view for the visible cells
+        if not index.isValid():
+            return None
+        record = self.records[index.row()]
+        if role == Qt.ItemDataRole.DecorationRole:
+            thumbnail = self.thumbnail(record)
+            if thumbnail is None:
+                self.request_thumbnail(record)
+                return self.placeholder
+            return thumbnail
+        if role == Qt.ItemDataRole.ToolTipRole:
+            return f'{record["title"]} by {record["author"]}'
+        return None
+
+    def append(self, record):
+        self.beginInsertRows(QModelIndex(), len(self.records), len(self.records))
+        self.records.append(record)
+        self.rows[self.key(record)] = len(self.records) - 1
+        self.endInsertRows()
+
+    def thumbnail(self, record):
+        key = self.key(record)
+        if key in self.thumbnails:
+            self.thumbnails.move_to_end(key)
+            return self.thumbnails[key]
+        return None
+
+    def request_thumbnail(self, record):
+        key = self.key(record)
+        url = record["url"].get("thumb") or record["url"].get("mini")
+        if key in self.pending or not (url or record.get("path")):
+            return
+        self.pending.add(key)
+        worker = ThumbnailWorker(key, url, THUMBNAIL_SIZE, record.get("path"))
+        worker.signals.finish_thumbnail.connect(self.thumbnail_finished)
+        self.thread_pool.start(worker, THUMBNAIL_PRIORITY)
+
+    def thumbnail_finished(self, key, image):
+        self.pending.discard(key)
+        self.thumbnails[key] = self.placeholder if image.isNull() else QPixmap.fromImage(image)
+        while len(self.thumbnails) > self.cache_size:
+            self.thumbnails.popitem(last=False)
+        if key in self.rows:
+            index = self.index(self.rows[key])
+            self.dataChanged.emit(index, index, [Qt.ItemDataRole.DecorationRole])
+
+
+class FilmStrip(QListView):
+    def __init__(self, model, parent=None):
+        super().__init__(parent)
+        self.setModel(model)
+        self.setViewMode(QListView.ViewMode.IconMode)
+        self.setFlow(QListView.Flow.LeftToRight)
+        self.setWrapping(False)
+        self.setUniformItemSizes(True)
+        self.setLayoutMode(QListView.LayoutMode.Batched)
+        self.setMovement(QListView.Movement.Static)
+        self.setIconSize(THUMBNAIL_SIZE)
+        self.setSpacing(2)
+        self.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.setSelectionMode(QAbstractItemView.SelectionMode.SingleSelection)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOn)
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+        self.setFixedHeight(THUMBNAIL_SIZE.height() + 30)
+        self.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Fixed)
+
+    def select_row(self, row):
+        if 0 <= row < self.model().rowCount():
+            index = self.model().index(row)
+            self.setCurrentIndex(index)
+            self.scrollTo(index)
 
 
 class ReadOnlyLineEdit(QLineEdit):
@@ -57,10 +186,10 @@ class TaskViewWindow(QWidget):
         self.setLayout(QVBoxLayout())
         self.layout().setAlignment(Qt.AlignmentFlag.AlignTop | Qt.AlignmentFlag.AlignLeft)
         self.__init_widgets()
-        self.timer = QTimer()
-        self.timer.setInterval(100)
-        self.timer.timeout.connect(self.update_list)
-        self.timer.start()
+        self.items = {}  # uid -> (QListWidgetItem, QProgressBar)
+        self.values = {}  # uid -> progress not shown yet, applied once per event loop pass
+        self.mainwindow.state.progress_changed.connect(self.update_item)
+        self.mainwindow.state.progress_removed.connect(self.remove_item)
         self.selection = "all"
         self.setWindowTitle("Task Viewer")
 
@@ -99,18 +228,42 @@ class TaskViewWindow(QWidget):
     def kill_task(self):
         self.mainwindow.term_signal.emit(self.selection)
 
-    def update_list(self):
-        self.list.clear()
-        progresses = self.mainwindow.progresses_getimage.copy()
-        progresses.update(self.mainwindow.progresses_saveimage.copy())
-        for k, v in progresses.items():
-            item = QListWidgetItem((k + (" " * 10))[:10] + " - %.2f%%" % v)
+    def update_item(self, uid, value):
+        if not self.values:
+            QTimer.singleShot(0, self.show_values)
+        self.values[uid] = value
+
+    def show_values(self):
+        values, self.values = self.values, {}
+        if not self.isVisible():  # See showEvent
+            return
+        for uid, value in values.items():
+            if uid in self.mainwindow.state.progresses_getimage or uid in self.mainwindow.state.progresses_saveimage:
+                self.show_item(uid, value)
+
+    def showEvent(self, a0):  # Catch up with the progress skipped while hidden
+        for uid, value in {**self.mainwindow.state.progresses_getimage,
+                           **self.mainwindow.state.progresses_saveimage}.items():
+            self.show_item(uid, value)
+        super().showEvent(a0)
+
+    def show_item(self, uid, value):
+        if uid not in self.items:
+            item = QListWidgetItem()
             self.list.addItem(item)
             progress = QProgressBar()
             progress.setRange(0, 100)
             progress.setDisabled(True)
-            progress.setValue(int(v))
             self.list.setItemWidget(item, progress)
+            self.items[uid] = (item, progress)
+        item, progress = self.items[uid]
+        item.setText((uid + (" " * 10))[:10] + " - %.2f%%" % value)
+        progress.setValue(int(value))
+
+    def remove_item(self, uid):
+        if uid in self.items:
+            item, _ = self.items.pop(uid)
+            self.list.takeItem(self.list.row(item))
 
 
 class SettingsDialog(QDialog):
@@ -124,6 +277,8 @@ class SettingsDialog(QDialog):
         self.configs = self.mainwindow.configs.copy()
         self.configs["authors"] = self.mainwindow.configs["authors"].copy()
         self.configs["tag"] = self.mainwindow.configs["tag"].copy()
+        self.configs["excluded_tags"] = self.mainwindow.configs["excluded_tags"].copy()
+        self.configs["excluded_authors"] = self.mainwindow.configs["excluded_authors"].copy()
         self.add_author_dialog = AddAuthorDialog(path)
         self.__init_widgets()
         self.restore_status = False
@@ -225,6 +380,61 @@ class SettingsDialog(QDialog):
         self.image_settings.layout().addWidget(self.label_save_quality, 4, 0)
         self.image_settings.layout().addLayout(self.btn_layout_2, 4, 1)
 
+        self.label_save_format = QLabel("Save Format:")  # Transcoding on save
+        self.label_save_format.setAlignment(Qt.AlignmentFlag.AlignRight)
+        self.btn_group_save_format = QButtonGroup()
+        self.save_format_radiobuttons = {
+            "": QRadioButton("Keep"),
+            "jpg": QRadioButton("JPEG"),
+            "png": QRadioButton("PNG"),
+            "webp": QRadioButton("WebP")
+        }
+        for btn in self.save_format_radiobuttons.values():
+            self.btn_group_save_format.addButton(btn)
+        self.btn_layout_save_format = QHBoxLayout()
+        for btn in self.save_format_radiobuttons.values():
+            self.btn_layout_save_format.addWidget(btn)
+        for btn in self.save_format_radiobuttons.values():
+            btn.clicked.connect(partial(self.radiobutton_change, "save_format"))
+        self.image_settings.layout().addWidget(self.label_save_format, 5, 0)
+        self.image_settings.layout().addLayout(self.btn_layout_save_format, 5, 1)
+
+        self.label_save_image_quality = QLabel("Encoding Quality:")
+        self.label_save_image_quality.setAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+        self.save_image_quality_spinbox = QSpinBox()
+        self.save_image_quality_spinbox.setRange(1, 100)
+        self.save_image_quality_spinbox.valueChanged.connect(partial(self.spinbox_slider_change, "save_image_quality"))
+        self.image_settings.layout().addWidget(self.label_save_image_quality, 6, 0)
+        self.image_settings.layout().addWidget(self.save_image_quality_spinbox, 6, 1)
+
+        self.label_save_max_size = QLabel("Max Dimension:")
+        self.label_save_max_size.setAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+        self.save_max_size_spinbox = QSpinBox()
+        self.save_max_size_spinbox.setRange(0, 100000)
+        self.save_max_size_spinbox.setSingleStep(100)
+        self.save_max_size_spinbox.setSpecialValueText("No limit")
+        self.save_max_size_spinbox.setSuffix(" px")
+        self.save_max_size_spinbox.valueChanged.connect(partial(self.spinbox_slider_change, "save_max_size"))
+        self.image_settings.layout().addWidget(self.label_save_max_size, 7, 0)
+        self.image_settings.layout().addWidget(self.save_max_size_spinbox, 7, 1)
+
+        self.label_save_sidecar = QLabel("Save Metadata (.json):")
+        self.label_save_sidecar.setAlignment(Qt.AlignmentFlag.AlignRight)
+        self.btn_group_save_sidecar = QButtonGroup()
+        self.save_sidecar_radiobuttons = {
+            0: QRadioButton("No"),
+            1: QRadioButton("Yes")
+        }
+        for btn in self.save_sidecar_radiobuttons.values():
+            self.btn_group_save_sidecar.addButton(btn)
+        self.btn_layout_save_sidecar = QHBoxLayout()
+        for btn in self.save_sidecar_radiobuttons.values():
+            self.btn_layout_save_sidecar.addWidget(btn)
+        for btn in self.save_sidecar_radiobuttons.values():
+            btn.clicked.connect(partial(self.radiobutton_change, "save_sidecar"))
+        self.image_settings.layout().addWidget(self.label_save_sidecar, 8, 0)
+        self.image_settings.layout().addLayout(self.btn_layout_save_sidecar, 8, 1)
+
         self.tag_settings = QWidget()  # Tag Settings container
         self.tab_widget.addTab(self.tag_settings, "Tags")
         self.tag_settings.setLayout(QHBoxLayout())
@@ -273,6 +483,25 @@ class SettingsDialog(QDialog):
         self.author_settings.layout().addWidget(self.author_list)
         self.author_settings.layout().addLayout(self.author_btn_layout)
 
+        self.filter_settings = QWidget()  # Excluded tags and authors
+        self.filter_settings.setLayout(QGridLayout())
+        self.filter_settings.layout().setAlignment(Qt.AlignmentFlag.AlignTop)
+        self.tab_widget.addTab(self.filter_settings, "Filters")
+        self.excluded_tags_label = QLabel("Excluded tags:")
+        self.excluded_tags_label.setAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+        self.filter_settings.layout().addWidget(self.excluded_tags_label, 0, 0)
+        self.excluded_tags_text = QLineEdit()
+        self.excluded_tags_text.setPlaceholderText("Separate with commas")
+        self.excluded_tags_text.textEdited.connect(partial(self.text_list_change, "excluded_tags"))
+        self.filter_settings.layout().addWidget(self.excluded_tags_text, 0, 1)
+        self.excluded_authors_label = QLabel("Excluded authors:")
+        self.excluded_authors_label.setAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+        self.filter_settings.layout().addWidget(self.excluded_authors_label, 1, 0)
+        self.excluded_authors_text = QLineEdit()
+        self.excluded_authors_text.setPlaceholderText("Names or uids, separate with commas")
+        self.excluded_authors_text.textEdited.connect(partial(self.text_list_change, "excluded_authors"))
+        self.filter_settings.layout().addWidget(self.excluded_authors_text, 1, 1)
+
         self.misc_settings = QWidget()  # Others, e.g. cache number...
         self.misc_settings.setLayout(QGridLayout())
         self.misc_settings.layout().setAlignment(Qt.AlignmentFlag.AlignTop)
@@ -282,11 +511,11 @@ class SettingsDialog(QDialog):
         self.misc_settings.layout().addWidget(self.keep_label, 0, 0)
         self.keep_layout = QHBoxLayout()
         self.keep_slidebar = QSlider(Qt.Orientation.Horizontal)
-        self.keep_slidebar.setRange(0, 20)
+        self.keep_slidebar.setRange(0, 500)
         self.keep_slidebar.sliderMoved.connect(partial(self.spinbox_slider_change, "keep"))
         self.keep_layout.addWidget(self.keep_slidebar)
         self.keep_spinbox = QSpinBox()
-        self.keep_spinbox.setRange(0, 20)
+        self.keep_spinbox.setRange(0, 500)
         self.keep_spinbox.valueChanged.connect(partial(self.spinbox_slider_change, "keep"))
         self.keep_spinbox.setSingleStep(1)
         self.keep_layout.addWidget(self.keep_spinbox)
@@ -324,6 +553,77 @@ class SettingsDialog(QDialog):
             btn.clicked.connect(partial(self.radiobutton_change, "suppress"))
         self.misc_settings.layout().addLayout(self.btn_layout_suppress_warnings, 2, 1)
 
+        self.persist_queue_label = QLabel("Restore queue on start:")  # Warm start toggle
+        self.persist_queue_label.setAlignment(Qt.AlignmentFlag.AlignRight)
+        self.misc_settings.layout().addWidget(self.persist_queue_label, 3, 0)
+        self.btn_group_persist_queue = QButtonGroup()
+        self.btn_layout_persist_queue = QHBoxLayout()
+        self.persist_queue_radiobuttons = {
+            0: QRadioButton("Off"),
+            1: QRadioButton("URLs"),
+            2: QRadioButton("URLs and images")
+        }
+        for btn in self.persist_queue_radiobuttons.values():
+            self.btn_group_persist_queue.addButton(btn)
+        for btn in self.persist_queue_radiobuttons.values():
+            self.btn_layout_persist_queue.addWidget(btn)
+        for btn in self.persist_queue_radiobuttons.values():
+            btn.clicked.connect(partial(self.radiobutton_change, "persist"))
+        self.misc_settings.layout().addLayout(self.btn_layout_persist_queue, 3, 1)
+
+        self.shutdown_label = QLabel("Exit within (seconds):")  # Shutdown deadline
+        self.shutdown_label.setAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+        self.misc_settings.layout().addWidget(self.shutdown_label, 4, 0)
+        self.shutdown_spinbox = QSpinBox()
+        self.shutdown_spinbox.setRange(1, 60)
+        self.shutdown_spinbox.valueChanged.connect(partial(self.spinbox_slider_change, "shutdown"))
+        self.misc_settings.layout().addWidget(self.shutdown_spinbox, 4, 1)
+
+        self.process_pool_label = QLabel("Process images on all cores:")  # Process pool toggle
+        self.process_pool_label.setAlignment(Qt.AlignmentFlag.AlignRight)
+        self.misc_settings.layout().addWidget(self.process_pool_label, 5, 0)
+        self.btn_group_process_pool = QButtonGroup()
+        self.btn_layout_process_pool = QHBoxLayout()
+        self.process_pool_radiobuttons = {
+            0: QRadioButton("No"),
+            1: QRadioButton("Yes")
+        }
+        for btn in self.process_pool_radiobuttons.values():
+            self.btn_group_process_pool.addButton(btn)
+        for btn in self.process_pool_radiobuttons.values():
+            self.btn_layout_process_pool.addWidget(btn)
+        for btn in self.process_pool_radiobuttons.values():
+            btn.clicked.connect(partial(self.radiobutton_change, "process_pool"))
+        self.misc_settings.layout().addLayout(self.btn_layout_process_pool, 5, 1)
+
+        self.bandwidth_labels = {  # Bandwidth limits, KB/s
+            "view": QLabel("Bandwidth for viewing:"),
+            "prefetch": QLabel("Bandwidth for prefetching:"),
+            "save": QLabel("Bandwidth for saving:")
+        }
+        self.bandwidth_spinboxes = {}
+        for i, traffic in enumerate(TRAFFIC):
+            self.bandwidth_labels[traffic].setAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+            self.misc_settings.layout().addWidget(self.bandwidth_labels[traffic], 6 + i, 0)
+            spinbox = QSpinBox()
+            spinbox.setRange(0, 1000000)
+            spinbox.setSingleStep(100)
+            spinbox.setSpecialValueText("No limit")
+            spinbox.setSuffix(" KB/s")
+            spinbox.setStatusTip("With several windows open, the lowest limit set in any of them applies.")
+            spinbox.valueChanged.connect(partial(self.spinbox_slider_change, "bandwidth_" + traffic))
+            self.bandwidth_spinboxes[traffic] = spinbox
+            self.misc_settings.layout().addWidget(spinbox, 6 + i, 1)
+
+        self.slideshow_label = QLabel("Slideshow interval:")  # Slideshow
+        self.slideshow_label.setAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+        self.misc_settings.layout().addWidget(self.slideshow_label, 9, 0)
+        self.slideshow_spinbox = QSpinBox()
+        self.slideshow_spinbox.setRange(1, 3600)
+        self.slideshow_spinbox.setSuffix(" s")
+        self.slideshow_spinbox.valueChanged.connect(partial(self.spinbox_slider_change, "slideshow"))
+        self.misc_settings.layout().addWidget(self.slideshow_spinbox, 9, 1)
+
         self.finish_btn_layout = QHBoxLayout()
         self.finish_btn_layout.setAlignment(Qt.AlignmentFlag.AlignRight)
         self.ok_btn = QPushButton("OK")
@@ -341,6 +641,8 @@ class SettingsDialog(QDialog):
         self.configs = self.mainwindow.configs.copy()
         self.configs["authors"] = self.mainwindow.configs["authors"].copy()
         self.configs["tag"] = self.mainwindow.configs["tag"].copy()
+        self.configs["excluded_tags"] = self.mainwindow.configs["excluded_tags"].copy()
+        self.configs["excluded_authors"] = self.mainwindow.configs["excluded_authors"].copy()
         self.restore_widget_status()
         return super().exec()
 
@@ -374,8 +676,6 @@ class SettingsDialog(QDialog):
     def btn_actions(self, type_, action):
         if type_ == "author":
             if action == "add":
-                if self.author_list.count() >= 20:
-                    return QMessageBox.warning(self, "Warning", "You can only specific up to 20 authors.")
                 status = self.add_author_dialog.exec()
                 if status:
                     value = self.add_author_dialog.get_data()
@@ -443,6 +743,22 @@ class SettingsDialog(QDialog):
             for k, v in self.suppress_warnings_radiobuttons.items():
                 if v.isChecked():
                     self.configs["suppress_warnings"] = k
+        elif type_ == "persist":
+            for k, v in self.persist_queue_radiobuttons.items():
+                if v.isChecked():
+                    self.configs["persist_queue"] = k
+        elif type_ == "process_pool":
+            for k, v in self.process_pool_radiobuttons.items():
+                if v.isChecked():
+                    self.configs["process_pool"] = k
+        elif type_ == "save_format":
+            for k, v in self.save_format_radiobuttons.items():
+                if v.isChecked():
+                    self.configs["save_format"] = k
+        elif type_ == "save_sidecar":
+            for k, v in self.save_sidecar_radiobuttons.items():
+                if v.isChecked():
+                    self.configs["save_sidecar"] = k
 
     def spinbox_slider_change(self, type_, num):
         if type_ == "keep":
@@ -453,6 +769,24 @@ class SettingsDialog(QDialog):
             self.configs["cache_num"] = num
             self.cache_spinbox.setValue(num)
             self.cache_slidebar.setValue(num)
+        elif type_ == "shutdown":
+            self.configs["shutdown_timeout"] = num
+            self.shutdown_spinbox.setValue(num)
+        elif type_ == "save_image_quality":
+            self.configs["save_image_quality"] = num
+            self.save_image_quality_spinbox.setValue(num)
+        elif type_ == "save_max_size":
+            self.configs["save_max_size"] = num
+            self.save_max_size_spinbox.setValue(num)
+        elif type_ == "slideshow":
+            self.configs["slideshow_interval"] = num
+            self.slideshow_spinbox.setValue(num)
+        elif type_[:10] == "bandwidth_":
+            self.configs[type_] = num
+            self.bandwidth_spinboxes[type_[10:]].setValue(num)
+
+    def text_list_change(self, key, text):
+        self.configs[key] = [x.strip() for x in text.split(",") if x.strip()]
 
     def restore_widget_status(self):
         self.restore_status = True
@@ -461,9 +795,21 @@ class SettingsDialog(QDialog):
         self.view_quality_radiobuttons[self.configs["view_quality"]].setChecked(True)
         self.save_quality_radiobuttons[self.configs["save_quality"]].setChecked(True)
         self.suppress_warnings_radiobuttons[self.configs["suppress_warnings"]].setChecked(True)
+        self.persist_queue_radiobuttons[self.configs["persist_queue"]].setChecked(True)
+        self.process_pool_radiobuttons[self.configs["process_pool"]].setChecked(True)
         self.directory_text.setText(self.configs["save_dir"])
+        self.excluded_tags_text.setText(", ".join(self.configs["excluded_tags"]))
+        self.excluded_authors_text.setText(", ".join(self.configs["excluded_authors"]))
         self.spinbox_slider_change("keep", self.configs["keep_num"])
         self.spinbox_slider_change("cache", self.configs["cache_num"])
+        self.spinbox_slider_change("shutdown", self.configs["shutdown_timeout"])
+        self.spinbox_slider_change("save_image_quality", self.configs["save_image_quality"])
+        self.spinbox_slider_change("save_max_size", self.configs["save_max_size"])
+        for traffic in TRAFFIC:
+            self.spinbox_slider_change("bandwidth_" + traffic, self.configs["bandwidth_" + traffic])
+        self.spinbox_slider_change("slideshow", self.configs["slideshow_interval"])
+        self.save_format_radiobuttons[self.configs["save_format"]].setChecked(True)
+        self.save_sidecar_radiobuttons[self.configs["save_sidecar"]].setChecked(True)
         self.tags_list.clear()
         self.tags_list.setColumnCount(0)
         self.tags_list.setRowCount(0)
@@ -508,9 +854,11 @@ class SettingsDialog(QDialog):
 
     def save_changes(self):
         self.mainwindow.term_signal.emit("fetch")
-        self.mainwindow.images.clear()
-        self.mainwindow.image_data.clear()
+        self.mainwindow.clear_queue()
         self.mainwindow.configs = self.configs
+        DownloadEngine.instance().apply_settings()
+        self.mainwindow.slideshow_timer.setInterval(self.configs["slideshow_interval"] * 1000)
+        self.mainwindow.watch_gallery()  # The queue was cleared, and save_dir may point elsewhere now
 
 
 class WaitForTaskDialog(QDialog):
@@ -523,9 +871,11 @@ class WaitForTaskDialog(QDialog):
         label.setAlignment(Qt.AlignmentFlag.AlignCenter)
         self.layout().addWidget(label)
         self.task_finished = False
-        self.timer = QTimer()
-        self.timer.setInterval(100)
-        self.timer.timeout.connect(self.detect_tasks)
+        self.mainwindow.state.progress_removed.connect(self.detect_tasks)
+        self.mainwindow.state.getting_url_changed.connect(self.detect_tasks)
+        self.deadline = QTimer()  # Stop waiting for the tasks which do not respond in time
+        self.deadline.setSingleShot(True)
+        self.deadline.timeout.connect(self.give_up)
         self.setWindowFlag(Qt.WindowType.FramelessWindowHint)
         self.setFixedSize(300, 70)
 
@@ -537,10 +887,21 @@ class WaitForTaskDialog(QDialog):
     def keyPressEvent(self, a0):
         a0.ignore()
 
-    def detect_tasks(self):
+    def exec(self):
         self.mainwindow.term_signal.emit("all")
-        if not (self.mainwindow.progresses_getimage or self.mainwindow.progresses_saveimage or
-                self.mainwindow.getting_url):
+        if not self.mainwindow.state.busy():
+            self.task_finished = True
+            return
+        self.deadline.start(self.mainwindow.configs["shutdown_timeout"] * 1000)
+        return super().exec()
+
+    def give_up(self):
+        self.task_finished = True
+        self.close()
+
+    def detect_tasks(self):
+        if self.isVisible() and not self.mainwindow.state.busy():
+            self.deadline.stop()
             self.task_finished = True
             self.close()
 
@@ -563,19 +924,51 @@ class DetailDialog(QDialog):
         self.title_pid.setText(f"{self.data['title']} - {self.data['pid']}")
         self.author_uid.setText(f"{self.data['author']} - {self.data['uid']}")
         self.tags.setText(f"{', '.join(self.data['tags'])}")
-        self.is_ai.setText({0: "Yes" if include_list(["AI", "AI 画作", "NovelAI"], self.data['tags']) else "Unknown",
+        self.is_ai.setText({0: "Yes" if is_ai(self.data) else "Unknown",
                             1: "No", 2: "Yes"}[self.data["ai_type"]])
         self.is_r18.setText("Yes" if "R-18" in self.data["tags"] else "No")
         self.links.setText(', '.join([f'<a href={url}>{type_}</a>' for type_, url in self.data["url"].items()]))
         self.pixiv_link.setText(f"<a href=https://www.pixiv.net/artworks/{self.data['pid']}#{self.data['p']}>Open</a>")
 
 
-def include_list(iter_target, iter_dest):
-    include = False
-    for i in iter_target:
-        if i in iter_dest:
-            include = True
-    return include
+class SearchDialog(QWidget):  # Search every image fetched so far, results update while typing
+    def __init__(self, mainwindow):
+        super().__init__()
+        self.mainwindow = mainwindow
+        self.setLayout(QVBoxLayout())
+        self.results = []
+        self.__init_widgets()
+        self.setWindowTitle("Search")
+        self.resize(400, 500)
+
+    def __init_widgets(self):
+        self.text = QLineEdit()
+        self.text.setPlaceholderText("tag1|tag2, tag3, author:name, uid:12345")
+        self.text.setStatusTip("Groups separated by commas must all match, alternatives separated by | any.")
+        self.text.textChanged.connect(self.search)
+        self.layout().addWidget(self.text)
+
+        self.label = QLabel()
+        self.layout().addWidget(self.label)
+
+        self.list = QListWidget()
+        self.list.itemActivated.connect(lambda item: self.mainwindow.show_record(self.results[self.list.row(item)]))
+        self.layout().addWidget(self.list)
+
+    def showEvent(self, a0):
+        self.text.setFocus()
+        self.search(self.text.text())
+        super().showEvent(a0)
+
+    def search(self, text):
+        index = self.mainwindow.engine.tag_index
+        count, self.results = index.search(text)
+        self.list.clear()
+        self.list.addItems([f'{x["title"]} - {x["pid"]} by {x["author"]}' for x in self.results])
+        self.label.setText(f"{count} match(es), showing the newest {len(self.results)}" if count > len(self.results)
+                           else f"{count} match(es)")
+        if not index.loaded:
+            self.label.setText(self.label.text() + " (still reading the saved index...)")
 
 
 class AddAuthorDialog(QDialog):